@@ -0,0 +1,600 @@
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+PLAYER_NAME = "Benchmark#1234"
+CLAN_ID = "4242"
+
+MEMBERSHIP_TYPE = 3
+FIRST_MEMBERSHIP_ID = 4611686018400000000
+FIRST_CHARACTER_ID = 2305843009200000000
+FIRST_INSTANCE_ID = 10000000000
+
+ACTIVITIES_PER_PAGE = 250
+MEMBERS_PER_PAGE = 100
+NEWEST_ACTIVITY = datetime(2022, 1, 1, tzinfo=timezone.utc).timestamp()
+ACTIVITY_SPACING = 1800
+
+# GameMode, share of the history, playerCount
+MODES = [
+    (4, 0.10, 6),  # raid
+    (82, 0.05, 3),  # dungeon
+    (3, 0.20, 3),  # strike
+    (6, 0.25, 1),  # patrol
+    (5, 0.40, 12),  # pvp
+]
+
+# GameMode -> name of the mode, name of the activity, for the manifest
+ACTIVITY_NAMES = {
+    4: ("Raid", "Vault of Glass"),
+    82: ("Dungeon", "Pit of Heresy"),
+    3: ("Vanguard Ops", "The Inverted Spire"),
+    6: ("Explore", "The Dreaming City"),
+    5: ("All PvP", "Control"),
+}
+
+CLASS_NAMES = {0: "Titan", 1: "Hunter", 2: "Warlock"}
+
+# weapons players use in PGCRs, as item hashes. Most players use a few popular ones
+WEAPON_HASHES = [random.Random(weapon).randrange(2 ** 32) for weapon in range(80)]
+
+EMBLEM_HASHES = [random.Random(-emblem - 1).randrange(2 ** 32) for emblem in range(30)]
+EMBLEM_ICONS = {
+    emblem_hash: "/common/destiny2_content/icons/{:032x}.jpg".format(random.Random(emblem_hash).getrandbits(128))
+    for emblem_hash in EMBLEM_HASHES
+}
+RACE_HASHES = [898834093, 2803282938, 3887404748]
+GENDER_HASHES = [2204441813, 3111576190]
+
+# teamId, name of the team, of PvP activities
+TEAMS = [(17, "Alpha"), (18, "Bravo")]
+
+MANIFEST_PATH = "/common/destiny2_content/sqlite/en/world_sql_content_benchmark.content"
+
+# chance for a slot in a fireteam activity to be taken by a clanmate
+CLANMATE_CHANCE = 0.3
+
+
+class MockBungieServer:
+    """
+    A local stand-in for the parts of the Bungie API that the program uses, for benchmarks.
+
+    Serves a generated clan and activity history of a single player. Everything is derived from the
+    configuration, so the same configuration always serves the same data.
+    The server runs in its own process, so it does not compete with the measured program for the GIL.
+    """
+
+    def __init__(self, activities: int = 1000, characters: int = 3, clan_size: int = 100,
+                 latency: float = 0.0, slow_rate: float = 0.0, slow_latency: float = 1.0,
+                 throttle_rate: float = 0.0, throttle_seconds: int = 1, error_rate: float = 0.0, seed: int = 0):
+        """
+        :param activities: The amount of activities in the history of the player, split across all characters.
+        :param characters: The amount of characters of the player.
+        :param clan_size: The amount of clan members, including the player.
+        :param latency: The amount of seconds every response is delayed by.
+        :param slow_rate: The share of requests that are delayed by slow_latency instead, to simulate tail latency.
+        :param slow_latency: The amount of seconds slow responses are delayed by.
+        :param throttle_rate: The share of requests that are answered with a throttle hint.
+        :param throttle_seconds: The amount of seconds throttle hints ask for.
+        :param error_rate: The share of requests that are answered with a server error.
+        :param seed: Seeds the random throttle hints and errors.
+        """
+        self.config = {
+            "activities": activities,
+            "characters": characters,
+            "clan_size": clan_size,
+            "latency": latency,
+            "slow_rate": slow_rate,
+            "slow_latency": slow_latency,
+            "throttle_rate": throttle_rate,
+            "throttle_seconds": throttle_seconds,
+            "error_rate": error_rate,
+            "seed": seed
+        }
+
+        self.process = None
+        self.root = None
+
+    def start(self) -> str:
+        """
+        Starts the server process.
+
+        :return: The root URL to use for Settings.Advanced_ApiRoot and Settings.Advanced_StatsRoot.
+                 The manifest is served below the same host, see content_root.
+        """
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+
+        self.process = context.Process(target=_serve, args=(self.config, port_queue), daemon=True)
+        self.process.start()
+
+        self.root = "http://127.0.0.1:{}/Platform".format(port_queue.get(timeout=30))
+        return self.root
+
+    @property
+    def content_root(self) -> str:
+        """
+        :return: The root URL to use for Settings.Advanced_ContentRoot.
+        """
+        return self.root[:-len("/Platform")]
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def get_stats(self) -> dict:
+        """
+        :return: The amount of requests served so far, by endpoint, and the amount of bytes sent.
+        """
+        with urlopen(self.root + "/_stats/") as response:
+            return json.load(response)
+
+
+def create_manifest(filename: str) -> None:
+    """
+    Writes a small manifest content database with the activities and classes the server uses,
+    in the format Bungie uses.
+
+    :param filename: The file to write to.
+    """
+    connection = sqlite3.connect(filename)
+
+    with connection:
+        for table in ("DestinyActivityDefinition", "DestinyActivityModeDefinition", "DestinyClassDefinition"):
+            connection.execute("CREATE TABLE " + table + " (id INTEGER PRIMARY KEY NOT NULL, json BLOB)")
+
+        for mode, (mode_name, activity_name) in ACTIVITY_NAMES.items():
+            # the ids are the hashes as signed 32 bit integers
+            connection.execute("INSERT INTO DestinyActivityDefinition VALUES (?, ?)", (1000 + mode, json.dumps({
+                "hash": 1000 + mode,
+                "displayProperties": {"name": activity_name},
+                "directActivityModeType": mode,
+                "activityModeTypes": [mode]
+            })))
+            connection.execute("INSERT INTO DestinyActivityModeDefinition VALUES (?, ?)", (-mode, json.dumps({
+                "hash": 2 ** 32 - mode,
+                "displayProperties": {"name": mode_name},
+                "modeType": mode
+            })))
+
+        for class_type, class_name in CLASS_NAMES.items():
+            connection.execute("INSERT INTO DestinyClassDefinition VALUES (?, ?)", (3000 + class_type, json.dumps({
+                "hash": 3000 + class_type,
+                "displayProperties": {"name": class_name},
+                "classType": class_type
+            })))
+
+    connection.close()
+
+
+def _zip_manifest() -> bytes:
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, os.path.basename(MANIFEST_PATH))
+        create_manifest(filename)
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as f:
+            f.write(filename, os.path.basename(MANIFEST_PATH))
+
+        return archive.getvalue()
+
+
+def _serve(config: dict, port_queue) -> None:
+    history = History(config)
+    server = _Server(("127.0.0.1", 0), _create_handler(history, config, _zip_manifest()))
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # the program cancels speculative requests, which closes their connections
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _stat(value: float, display_value: str = None) -> dict:
+    """
+    :return: A stat value like Bungie sends them, displayed as integer unless given otherwise.
+    """
+    return {"basic": {"value": float(value), "displayValue": display_value if display_value is not None
+                      else str(int(value))}}
+
+
+def _ratio_stat(value: float) -> dict:
+    return _stat(value, "{:.2f}".format(value))
+
+
+def _seconds_stat(seconds: int) -> dict:
+    return _stat(seconds, "{}m {}s".format(seconds // 60, seconds % 60))
+
+
+class History:
+    """
+    The generated data. Activity i is the i-th newest activity of the player.
+    """
+
+    def __init__(self, config: dict):
+        self.activities = config["activities"]
+        self.characters = config["characters"]
+        self.clan_size = config["clan_size"]
+
+        self.mode_thresholds = []
+        share_sum = 0.0
+        for mode, share, player_count in MODES:
+            share_sum += share
+            self.mode_thresholds.append((share_sum, mode, player_count))
+
+    @staticmethod
+    def membership_id(member_index: int) -> str:
+        return str(FIRST_MEMBERSHIP_ID + member_index)
+
+    @staticmethod
+    def character_id(character_index: int) -> str:
+        return str(FIRST_CHARACTER_ID + character_index)
+
+    def mode_of(self, index: int) -> tuple:
+        roll = random.Random(index).random()
+
+        for threshold, mode, player_count in self.mode_thresholds:
+            if roll < threshold:
+                return mode, player_count
+
+        return self.mode_thresholds[-1][1:]
+
+    def activity(self, index: int) -> dict:
+        mode, player_count = self.mode_of(index)
+        period = datetime.fromtimestamp(NEWEST_ACTIVITY - index * ACTIVITY_SPACING, timezone.utc)
+        rng = random.Random(index * 3 + 1)
+
+        values = self.player_values(rng, player_count, rng.randrange(600, 3600), TEAMS[0][0] if mode == 5 else None)
+
+        return {
+            "period": period.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "activityDetails": {
+                "referenceId": 1000 + mode,
+                "directorActivityHash": 1000 + mode,
+                "instanceId": str(FIRST_INSTANCE_ID + index),
+                "mode": mode,
+                "modes": [mode],
+                "isPrivate": False,
+                "membershipType": MEMBERSHIP_TYPE
+            },
+            "values": {stat_id: {"statId": stat_id, **value} for stat_id, value in values.items()}
+        }
+
+    def activity_page(self, character_index: int, page: int) -> dict:
+        # activities are dealt to the characters in turns
+        start = page * ACTIVITIES_PER_PAGE * self.characters + character_index
+        stop = min(start + ACTIVITIES_PER_PAGE * self.characters, self.activities)
+        indices = range(start, stop, self.characters)
+
+        if len(indices) == 0:
+            return {}
+
+        return {"activities": [self.activity(index) for index in indices]}
+
+    def pgcr(self, index: int) -> dict:
+        activity = self.activity(index)
+        player_count = int(activity["values"]["playerCount"]["basic"]["value"])
+        rng = random.Random(-index - 1)
+
+        membership_ids = [self.membership_id(0)]
+        for _ in range(player_count - 1):
+            if rng.random() < CLANMATE_CHANCE:
+                membership_ids.append(self.membership_id(rng.randrange(1, self.clan_size)))
+            else:
+                membership_ids.append(str(FIRST_MEMBERSHIP_ID - 1 - rng.randrange(10 ** 6)))
+
+        mode = activity["activityDetails"]["mode"]
+        duration = rng.randrange(600, 3600)
+        teams = TEAMS if mode == 5 else []
+
+        return {
+            "period": activity["period"],
+            "startingPhaseIndex": 0,
+            "activityWasStartedFromBeginning": rng.random() < 0.8,
+            "activityDetails": activity["activityDetails"],
+            "entries": [
+                self.pgcr_entry(rng, membership_id, player_count, duration,
+                                teams[slot % len(teams)][0] if len(teams) > 0 else None)
+                for slot, membership_id in enumerate(membership_ids)
+            ],
+            "teams": [
+                {
+                    "teamId": team_id,
+                    "standing": _stat(standing, "Victory" if standing == 0 else "Defeat"),
+                    "score": _stat(rng.randrange(50, 150)),
+                    "teamName": team_name
+                }
+                for standing, [team_id, team_name] in enumerate(teams)
+            ]
+        }
+
+    @staticmethod
+    def player_values(rng: random.Random, player_count: int, duration: int, team_id: int) -> dict:
+        """
+        :param team_id: The team of the player, None outside of PvP.
+        :return: The stats of a player in an activity, like Bungie sends them in PGCRs and the activity history.
+        """
+        kills = rng.randrange(80)
+        deaths = rng.randrange(25)
+        assists = rng.randrange(40)
+        start_seconds = rng.choice([0, 0, 0, rng.randrange(duration)])
+        score = kills * 100 + assists * 50 if team_id is not None else 0
+        completed = start_seconds == 0 or rng.random() < 0.5
+
+        values = {
+            "assists": _stat(assists),
+            "completed": _stat(1 if completed else 0, "Yes" if completed else "No"),
+            "deaths": _stat(deaths),
+            "kills": _stat(kills),
+            "opponentsDefeated": _stat(kills + assists),
+            "efficiency": _ratio_stat((kills + assists) / max(1, deaths)),
+            "killsDeathsRatio": _ratio_stat(kills / max(1, deaths)),
+            "killsDeathsAssists": _ratio_stat((kills + assists / 2) / max(1, deaths)),
+            "score": _stat(score),
+            "activityDurationSeconds": _seconds_stat(duration),
+            "completionReason": _stat(0 if rng.random() < 0.9 else 2, "Objective Completed"),
+            "fireteamId": _stat(rng.randrange(2 ** 62)),
+            "startSeconds": _seconds_stat(start_seconds),
+            "timePlayedSeconds": _seconds_stat(duration - start_seconds),
+            "playerCount": _stat(player_count),
+            "teamScore": _stat(rng.randrange(50, 150) if team_id is not None else 0)
+        }
+
+        if team_id is not None:
+            values["team"] = _stat(team_id, TEAMS[team_id - TEAMS[0][0]][1])
+            values["standing"] = _stat(team_id - TEAMS[0][0], "Victory" if team_id == TEAMS[0][0] else "Defeat")
+
+        return values
+
+    @staticmethod
+    def pgcr_entry(rng: random.Random, membership_id: str, player_count: int, duration: int, team_id: int) -> dict:
+        """
+        :return: The entry of a player in a PGCR, with stats and weapons like Bungie sends them.
+        """
+        class_type = rng.randrange(3)
+        emblem_hash = rng.choice(EMBLEM_HASHES)
+        values = History.player_values(rng, player_count, duration, team_id)
+        kills = int(values["kills"]["basic"]["value"])
+        precision_kills = rng.randrange(kills + 1)
+
+        weapons = []
+        # popular weapons come up more often than others
+        for weapon_hash in {WEAPON_HASHES[int(rng.random() ** 2 * len(WEAPON_HASHES))]
+                            for _ in range(rng.randrange(1, 5))}:
+            weapon_kills = rng.randrange(kills + 1)
+            weapon_precision_kills = rng.randrange(weapon_kills + 1)
+
+            weapons.append({
+                "referenceId": weapon_hash,
+                "values": {
+                    "uniqueWeaponKills": _stat(weapon_kills),
+                    "uniqueWeaponPrecisionKills": _stat(weapon_precision_kills),
+                    "uniqueWeaponKillsPrecisionKills": _stat(weapon_precision_kills / max(1, weapon_kills),
+                                                             "{:.0%}".format(weapon_precision_kills
+                                                                             / max(1, weapon_kills)))
+                }
+            })
+
+        return {
+            "standing": values["standing"]["basic"]["value"] if team_id is not None else 0,
+            "score": values["score"],
+            "player": {
+                "destinyUserInfo": {
+                    "iconPath": EMBLEM_ICONS[emblem_hash],
+                    "crossSaveOverride": 0,
+                    "applicableMembershipTypes": [MEMBERSHIP_TYPE],
+                    "isPublic": True,
+                    "membershipType": MEMBERSHIP_TYPE,
+                    "membershipId": membership_id,
+                    "displayName": "Guardian " + membership_id[-6:],
+                    "bungieGlobalDisplayName": "Guardian " + membership_id[-6:],
+                    "bungieGlobalDisplayNameCode": int(membership_id[-4:])
+                },
+                "characterClass": CLASS_NAMES[class_type],
+                "classHash": 3000 + class_type,
+                "raceHash": rng.choice(RACE_HASHES),
+                "genderHash": rng.choice(GENDER_HASHES),
+                "characterLevel": 50,
+                "lightLevel": rng.randrange(1500, 1610),
+                "emblemHash": emblem_hash
+            },
+            "characterId": str(FIRST_CHARACTER_ID + int(membership_id[-6:])),
+            "values": values,
+            "extended": {
+                "weapons": weapons,
+                "values": {
+                    "precisionKills": _stat(precision_kills),
+                    "weaponKillsGrenade": _stat(rng.randrange(10)),
+                    "weaponKillsMelee": _stat(rng.randrange(10)),
+                    "weaponKillsSuper": _stat(rng.randrange(10)),
+                    "weaponKillsAbility": _stat(rng.randrange(5))
+                }
+            }
+        }
+
+    def clan_page(self, page: int) -> dict:
+        start = (page - 1) * MEMBERS_PER_PAGE
+        stop = min(start + MEMBERS_PER_PAGE, self.clan_size)
+
+        return {
+            "results": [
+                {
+                    "groupId": CLAN_ID,
+                    "destinyUserInfo": {
+                        "membershipType": MEMBERSHIP_TYPE,
+                        "membershipId": self.membership_id(member_index),
+                        "displayName": "Member " + str(member_index),
+                        "bungieGlobalDisplayName": "Member " + str(member_index)
+                    }
+                }
+                for member_index in range(start, stop)
+            ],
+            "hasMore": stop < self.clan_size
+        }
+
+    def linked_profiles(self, membership_id: str) -> dict:
+        member_index = int(membership_id) - FIRST_MEMBERSHIP_ID
+
+        return {
+            "profiles": [{
+                "membershipType": MEMBERSHIP_TYPE,
+                "membershipId": membership_id,
+                "displayName": "Member " + str(member_index)
+            }]
+        }
+
+
+ROUTES = [
+    ("pgcr", re.compile(r"/Destiny2/Stats/PostGameCarnageReport/(\d+)/$")),
+    ("activities", re.compile(r"/Destiny2/\d+/Account/\d+/Character/(\d+)/Stats/Activities/$")),
+    ("linked_profiles", re.compile(r"/Destiny2/\d+/Profile/(\d+)/LinkedProfiles/$")),
+    ("profile", re.compile(r"/Destiny2/\d+/Profile/(\d+)/$")),
+    ("clan_members", re.compile(r"/GroupV2/(\d+)/Members/$")),
+    ("clan", re.compile(r"/GroupV2/(\d+)/$")),
+    ("search", re.compile(r"/Destiny2/SearchDestinyPlayerByBungieName/-?\d+/$")),
+    ("manifest", re.compile(r"/Destiny2/Manifest/$")),
+    ("manifest_content", re.compile(r"^" + re.escape(MANIFEST_PATH) + r"$")),
+]
+
+
+def _create_handler(history: History, config: dict, manifest_archive: bytes):
+    lock = threading.Lock()
+    rng = random.Random(config["seed"])
+    stats = {"requests": {}, "throttled": 0, "errors": 0, "bytes": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self) -> None:
+            super().setup()
+            # headers and body are written separately, which would wait for delayed ACKs otherwise
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def send_json(self, status: int, data: dict) -> None:
+            body = json.dumps(data).encode("utf8")
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+            with lock:
+                stats["bytes"] += len(body)
+
+        def send_response_content(self, response) -> None:
+            self.send_json(200, {
+                "Response": response,
+                "ErrorCode": 1,
+                "ThrottleSeconds": 0,
+                "ErrorStatus": "Success",
+                "Message": "Ok",
+                "MessageData": {}
+            })
+
+        def do_GET(self) -> None:
+            self.handle_request()
+
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.handle_request()
+
+        def handle_request(self) -> None:
+            url = urlparse(self.path)
+
+            if url.path.endswith("/_stats/"):
+                with lock:
+                    data = json.loads(json.dumps(stats))
+                return self.send_json(200, data)
+
+            for name, pattern in ROUTES:
+                match = pattern.search(url.path)
+                if match:
+                    break
+            else:
+                return self.send_json(404, {"ErrorCode": 2, "ThrottleSeconds": 0, "Message": "Not found"})
+
+            with lock:
+                stats["requests"][name] = stats["requests"].get(name, 0) + 1
+                roll = rng.random()
+                slow = rng.random() < config["slow_rate"]
+
+            latency = config["slow_latency"] if slow else config["latency"]
+            if latency > 0:
+                time.sleep(latency)
+
+            if roll < config["throttle_rate"]:
+                with lock:
+                    stats["throttled"] += 1
+                return self.send_json(429, {"ErrorCode": 36, "ThrottleSeconds": config["throttle_seconds"],
+                                            "ErrorStatus": "ThrottleLimitExceededMinutes"})
+
+            if roll < config["throttle_rate"] + config["error_rate"]:
+                with lock:
+                    stats["errors"] += 1
+                return self.send_json(500, {"ErrorCode": 3, "ThrottleSeconds": 0,
+                                            "ErrorStatus": "UnhandledException"})
+
+            query = parse_qs(url.query)
+
+            if name == "pgcr":
+                self.send_response_content(history.pgcr(int(match.group(1)) - FIRST_INSTANCE_ID))
+            elif name == "activities":
+                character_index = int(match.group(1)) - FIRST_CHARACTER_ID
+                self.send_response_content(history.activity_page(character_index, int(query["page"][0])))
+            elif name == "linked_profiles":
+                self.send_response_content(history.linked_profiles(match.group(1)))
+            elif name == "profile":
+                self.send_response_content({
+                    "characters": {"data": {
+                        history.character_id(character_index): {
+                            "characterId": history.character_id(character_index),
+                            "classType": character_index % 3
+                        }
+                        for character_index in range(history.characters)
+                    }}
+                })
+            elif name == "clan_members":
+                self.send_response_content(history.clan_page(int(query.get("currentpage", ["1"])[0])))
+            elif name == "manifest":
+                self.send_response_content({"version": "benchmark", "mobileWorldContentPaths": {"en": MANIFEST_PATH}})
+            elif name == "manifest_content":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Length", str(len(manifest_archive)))
+                self.end_headers()
+                self.wfile.write(manifest_archive)
+            elif name == "clan":
+                self.send_response_content({"detail": {"groupId": match.group(1), "name": "Benchmark Clan"}})
+            else:
+                self.send_response_content([{
+                    "membershipType": MEMBERSHIP_TYPE,
+                    "membershipId": history.membership_id(0),
+                    "displayName": PLAYER_NAME.split("#")[0]
+                }])
+
+    return Handler
@@ -0,0 +1,309 @@
+"""
+Runs the whole program against a local stand-in of the Bungie API and reports how long each stage takes.
+
+Run from the repository root:
+
+    python -m benchmarks.benchmark --activities 10000
+
+Every benchmark does two runs: "cold" starts with an empty data folder, "warm" reuses the caches of the cold run.
+Each run happens in a fresh process, like a real run of the program, so their peak memory can be told apart.
+With --baseline, the results are compared against an earlier --output file,
+and the exit code is 1 if a run got slower or used more memory than the tolerance allows. This is meant for CI.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.MockBungieServer import CLAN_ID, PLAYER_NAME, MockBungieServer
+
+# the functions run() calls, in the order it calls them
+STAGES = [
+    "get_manifest",
+    "get_player",
+    "get_clan_members_with_all_memberships",
+    "get_activity_batches",
+    "get_sorted_activities",
+    "get_activity_details",
+    "compare_against_clanmates",
+    "compare_against_clanmates_in_store",
+]
+
+RUNS = ["cold", "warm"]
+
+
+def parse_arguments(arguments: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks the program against a local mock of the Bungie API.")
+
+    parser.add_argument("--activities", type=int, default=1000, help="activities in the history of the player")
+    parser.add_argument("--characters", type=int, default=3, help="characters of the player")
+    parser.add_argument("--clan-size", type=int, default=100, help="members of the clan, including the player")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds every response is delayed by")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of requests that are slow")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="seconds slow responses are delayed by")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests that get throttled")
+    parser.add_argument("--throttle-seconds", type=int, default=1, help="seconds a throttle hint asks for")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument("--seed", type=int, default=0, help="seeds throttle hints and errors")
+
+    parser.add_argument("--threads", type=int, default=10, help="Settings.Advanced_AsyncThreadAmount")
+    parser.add_argument("--connections", type=int, default=None,
+                        help="Settings.Advanced_ConnectionPoolSize, defaults to --threads, "
+                             "as the mock speaks HTTP/1.1 and can not multiplex requests like Bungie")
+    parser.add_argument("--max-rate", type=float, default=1000.0, help="Settings.Advanced_MaxRequestsPerSecond")
+    parser.add_argument("--sqlite", action="store_true", help="Settings.UseSqliteStore")
+    parser.add_argument("--slim", action="store_true", help="Settings.SlimActivityDetails")
+    parser.add_argument("--first-meetings", action="store_true", help="Settings.OnlyFirstMeetings")
+    parser.add_argument("--shared", action="store_true", help="Settings.SharedActivityDetails")
+    parser.add_argument("--shared-max-megabytes", type=float, default=None,
+                        help="Settings.SharedActivityDetailsMaxMegabytes")
+    parser.add_argument("--hedge-quantile", type=float, default=None, help="Settings.Advanced_HedgeQuantile")
+    parser.add_argument("--mmap", action="store_true", help="Settings.Advanced_MemoryMapCaches")
+    parser.add_argument("--compression", choices=["gzip", "lzma", "zlib"], default=None,
+                        help="Settings.CompressCaches, see benchmarks.compression to compare all codecs to plain JSON")
+    parser.add_argument("--max-age-hours", type=float, default=None,
+                        help="leave the Requery* settings at None, with this as Settings.ClanmatesMaxAgeHours "
+                             "and Settings.ActivityBatchesMaxAgeHours, instead of requerying everything")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Settings.UseManifest, with a small manifest the mock serves")
+
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also measure the peak Python memory of each stage, which makes everything a lot slower")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results against this JSON file from --output")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed regression against the baseline, as share")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the program")
+
+    return parser.parse_args(arguments)
+
+
+def configure(options: argparse.Namespace, root: str, content_root: str, data_folder: str) -> None:
+    from src.Settings import Settings
+
+    Settings.ApiKey = "benchmark"
+    Settings.BungieName = PLAYER_NAME
+    Settings.ClanId = CLAN_ID
+
+    if options.max_age_hours is None:
+        Settings.RequeryClanmates = True
+        Settings.RequeryActivityBatches = True
+        Settings.RequeryActivityDetails = True
+    else:
+        Settings.ClanmatesMaxAgeHours = options.max_age_hours
+        Settings.ActivityBatchesMaxAgeHours = options.max_age_hours
+
+    Settings.OnlyFirstMeetings = options.first_meetings
+    Settings.UseSqliteStore = options.sqlite
+    Settings.SlimActivityDetails = options.slim
+    Settings.SharedActivityDetails = options.shared
+    Settings.SharedActivityDetailsMaxMegabytes = options.shared_max_megabytes
+    Settings.UseManifest = options.manifest
+
+    Settings.Advanced_AsyncThreadAmount = options.threads
+    Settings.Advanced_ConnectionPoolSize = options.connections or options.threads
+    Settings.Advanced_MaxRequestsPerSecond = options.max_rate
+    Settings.Advanced_HedgeQuantile = options.hedge_quantile
+    Settings.Advanced_MemoryMapCaches = options.mmap
+    Settings.CompressCaches = options.compression
+    Settings.Advanced_ApiRoot = root
+    Settings.Advanced_StatsRoot = root
+    Settings.Advanced_ContentRoot = content_root
+
+    Settings.DataFolder = data_folder
+
+
+@contextlib.contextmanager
+def measure_stages(functions, stages: dict, trace_memory: bool):
+    """
+    Wraps the stages of run(), so their wall time (and peak memory) are added to the given dict while active.
+
+    :param functions: The src.functions module.
+    :param stages: Maps stage names to dicts with "seconds" and, if tracing memory, "peak_bytes".
+    :param trace_memory: Whether tracemalloc is running.
+    """
+    originals = {name: getattr(functions, name) for name in STAGES}
+
+    def wrap(name, original):
+        def measured(*args, **kwargs):
+            if trace_memory:
+                tracemalloc.reset_peak()
+
+            start = time.perf_counter()
+
+            try:
+                return original(*args, **kwargs)
+            finally:
+                stage = stages.setdefault(name, {"seconds": 0.0})
+                stage["seconds"] += time.perf_counter() - start
+
+                if trace_memory:
+                    stage["peak_bytes"] = max(stage.get("peak_bytes", 0), tracemalloc.get_traced_memory()[1])
+
+        return measured
+
+    for name, original in originals.items():
+        setattr(functions, name, wrap(name, original))
+
+    try:
+        yield
+    finally:
+        for name, original in originals.items():
+            setattr(functions, name, original)
+
+
+def run_once(options: argparse.Namespace, root: str, content_root: str, data_folder: str) -> dict:
+    """
+    Does a single run of the program. Meant to be called in a fresh process.
+
+    :return: The wall time and peak memory of the run, and of its stages.
+    """
+    import src.functions as functions
+
+    configure(options, root, content_root, data_folder)
+
+    stages = {}
+
+    if options.trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+
+    with measure_stages(functions, stages, options.trace_memory), \
+            contextlib.redirect_stdout(sys.stdout if options.verbose else io.StringIO()):
+        functions.run()
+
+    seconds = time.perf_counter() - start
+
+    if options.trace_memory:
+        tracemalloc.stop()
+
+    return {
+        "seconds": seconds,
+        # in KiB on Linux
+        "peak_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "stages": stages
+    }
+
+
+def get_folder_size(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(folder) for name in names)
+
+
+def run_in_process(options: argparse.Namespace, server: MockBungieServer, data_folder: str) -> dict:
+    before = server.get_stats()
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        result = executor.submit(run_once, options, server.root, server.content_root, data_folder).result()
+
+    after = server.get_stats()
+
+    requests = {name: count - before["requests"].get(name, 0) for name, count in after["requests"].items()}
+    details_seconds = result["stages"].get("get_activity_details", {}).get("seconds", 0.0)
+
+    result.update({
+        "requests": requests,
+        "requests_per_second": sum(requests.values()) / result["seconds"],
+        "pgcrs_per_second": requests.get("pgcr", 0) / details_seconds if details_seconds > 0 else 0.0,
+        "throttled": after["throttled"] - before["throttled"],
+        "errors": after["errors"] - before["errors"],
+        "bytes_received": after["bytes"] - before["bytes"],
+        "cache_bytes": get_folder_size(data_folder)
+    })
+
+    return result
+
+
+def print_results(results: dict) -> None:
+    for run_name, result in results["runs"].items():
+        print("")
+        print("{}: {:.2f} s, {:.1f} MiB peak, {} requests ({:.1f}/s), {} PGCRs ({:.1f}/s), {} throttled, {} errors, "
+              "{:.1f} MiB cached"
+              .format(run_name, result["seconds"], result["peak_bytes"] / 2 ** 20, sum(result["requests"].values()),
+                      result["requests_per_second"], result["requests"].get("pgcr", 0), result["pgcrs_per_second"],
+                      result["throttled"], result["errors"], result["cache_bytes"] / 2 ** 20))
+
+        for name in STAGES:
+            if name not in result["stages"]:
+                continue
+
+            stage = result["stages"][name]
+            line = "  {:<40} {:>8.3f} s".format(name, stage["seconds"])
+
+            if "peak_bytes" in stage:
+                line += " {:>8.1f} MiB".format(stage["peak_bytes"] / 2 ** 20)
+
+            print(line)
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: A list of descriptions of all regressions, empty if there are none.
+    """
+    regressions = []
+
+    for run_name, result in results["runs"].items():
+        if run_name not in baseline["runs"]:
+            continue
+
+        for key in ("seconds", "peak_bytes"):
+            limit = baseline["runs"][run_name][key] * (1 + tolerance)
+
+            if result[key] > limit:
+                regressions.append("{} {}: {:.2f} exceeds baseline {:.2f} by more than {:.0%}".format(
+                    run_name, key, result[key], baseline["runs"][run_name][key], tolerance))
+
+    return regressions
+
+
+def main(arguments: list) -> int:
+    options = parse_arguments(arguments)
+
+    server = MockBungieServer(activities=options.activities, characters=options.characters,
+                              clan_size=options.clan_size, latency=options.latency,
+                              slow_rate=options.slow_rate, slow_latency=options.slow_latency,
+                              throttle_rate=options.throttle_rate, throttle_seconds=options.throttle_seconds,
+                              error_rate=options.error_rate, seed=options.seed)
+
+    results = {"options": vars(options), "runs": {}}
+
+    try:
+        server.start()
+
+        with tempfile.TemporaryDirectory() as data_folder:
+            for run_name in RUNS:
+                print("Running " + run_name + "...")
+                results["runs"][run_name] = run_in_process(options, server, data_folder)
+    finally:
+        server.stop()
+
+    print_results(results)
+
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline is not None:
+        with open(options.baseline, "r") as f:
+            regressions = compare_to_baseline(results, json.load(f), options.tolerance)
+
+        for regression in regressions:
+            sys.stderr.write("Regression: " + regression + "\n")
+
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,157 @@
+"""
+Compares the cache files of plain JSON against each codec of Settings.CompressCaches, side by side:
+their size, how long saving them takes, and how long opening and reading them takes.
+
+Run from the repository root:
+
+    python -m benchmarks.compression --activities 10000
+
+The activity history and activity details are the same the mock Bungie API serves (see MockBungieServer),
+generated directly instead of requested, so only the caches themselves are measured.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.MockBungieServer import ACTIVITIES_PER_PAGE, FIRST_INSTANCE_ID, History
+
+# None for plain JSON
+CODECS = [None, "gzip", "lzma", "zlib"]
+
+
+def parse_arguments(arguments: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compares the size and speed of compressed caches to plain JSON.")
+
+    parser.add_argument("--activities", type=int, default=10000, help="activities in the history of the player")
+    parser.add_argument("--characters", type=int, default=3, help="characters of the player")
+    parser.add_argument("--clan-size", type=int, default=100, help="members of the clan, including the player")
+    parser.add_argument("--slim", action="store_true", help="Settings.SlimActivityDetails")
+    parser.add_argument("--mmap", action="store_true", help="Settings.Advanced_MemoryMapCaches")
+    parser.add_argument("--output", help="write the results to this JSON file")
+
+    return parser.parse_args(arguments)
+
+
+def generate_batches(history: History, characters: int):
+    """
+    :return: An iterator of the batches of the whole history, as get_activity_batches() stores them.
+    """
+    from src.functions import create_batch
+
+    for character_index in range(characters):
+        for page in range(history.activities // ACTIVITIES_PER_PAGE + 1):
+            data = history.activity_page(character_index, page)
+
+            if "activities" not in data:
+                break
+
+            yield create_batch(history.character_id(character_index), character_index % 3, data["activities"])
+
+
+def measure_history(history: History, options: argparse.Namespace, folder: str, codec: str) -> dict:
+    """
+    :return: The size of the activity history file and how long writing and reading it took.
+             It is only ever read front to back, so there is nothing to open beforehand.
+    """
+    from src.CacheCompression import CacheCompression
+    from src.functions import read_json_array, write_json_array
+
+    filename = os.path.join(folder, "activities.json" + CacheCompression.stream_extension(codec))
+    batches = list(generate_batches(history, options.characters))
+
+    start = time.perf_counter()
+    write_json_array(filename, batches)
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in read_json_array(filename):
+        pass
+    read_seconds = time.perf_counter() - start
+
+    return {"bytes": os.path.getsize(filename), "save_seconds": save_seconds, "open_seconds": None,
+            "read_seconds": read_seconds}
+
+
+def measure_details(history: History, options: argparse.Namespace, folder: str, codec: str) -> dict:
+    """
+    :return: The size of the activity details cache file and how long saving, opening and reading all of it took.
+    """
+    from src.JsonPgcrCache import JsonPgcrCache
+
+    filename = os.path.join(folder, "pgcr.json")
+
+    cache = JsonPgcrCache(filename, slim=options.slim, use_mmap=options.mmap, compression=codec)
+    for index in range(history.activities):
+        cache.put_pgcr(history.pgcr(index))
+
+    start = time.perf_counter()
+    cache.save()
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cache = JsonPgcrCache(filename, slim=options.slim, use_mmap=options.mmap, compression=codec)
+    open_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(history.activities):
+        cache.get_pgcr(FIRST_INSTANCE_ID + index)
+    read_seconds = time.perf_counter() - start
+
+    return {"bytes": os.path.getsize(cache.filename), "save_seconds": save_seconds, "open_seconds": open_seconds,
+            "read_seconds": read_seconds}
+
+
+def print_results(results: dict) -> None:
+    for cache_name in ("history", "details"):
+        print("")
+        print("{:<10} {:>12} {:>8} {:>10} {:>10} {:>10}".format(cache_name, "size", "ratio", "save", "open", "read"))
+
+        plain = results["codecs"]["plain"][cache_name]
+
+        for codec_name, result in results["codecs"].items():
+            result = result[cache_name]
+            open_seconds = "{:>8.3f} s".format(result["open_seconds"]) if result["open_seconds"] is not None else "-"
+
+            print("{:<10} {:>8.1f} MiB {:>7.1%} {:>8.3f} s {:>10} {:>8.3f} s".format(
+                codec_name, result["bytes"] / 2 ** 20, result["bytes"] / plain["bytes"], result["save_seconds"],
+                open_seconds, result["read_seconds"]))
+
+
+def main(arguments: list) -> int:
+    options = parse_arguments(arguments)
+
+    from src.Settings import Settings
+    Settings.Advanced_MemoryMapCaches = options.mmap
+
+    history = History({"activities": options.activities, "characters": options.characters,
+                        "clan_size": options.clan_size})
+
+    results = {"options": vars(options), "codecs": {}}
+
+    for codec in CODECS:
+        codec_name = codec if codec is not None else "plain"
+        print("Measuring " + codec_name + "...")
+
+        with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+            results["codecs"][codec_name] = {
+                "history": measure_history(history, options, folder, codec),
+                "details": measure_details(history, options, folder, codec)
+            }
+
+    print_results(results)
+
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,7 @@
 import typing
+from datetime import datetime, timezone
+
+from src.Manifest import Manifest
 
 FilterType = typing.Literal["activity", "date", "character"]
 OperatorType = typing.Literal["after", "before", "is", "is not", "in", "not in"]
@@ -16,7 +19,7 @@ class ActivityFilterList:
 
         Possible filters are:
 
-        - "activity", filters by activity type. CURRENTLY BROKEN AND WILL NOT CHANGE BATCHES.
+        - "activity", filters by activity type, using all modes the activity counts towards.
           - supported operators: "is", "is not", "in", "not in"
           - value type: A GameMode value (or a list, depending on the operator)
                         See aiobungie.GameMode for a mapping.
@@ -43,3 +46,178 @@ class ActivityFilterList:
 
     def getFilters(self) -> list:
         return self.filters
+
+    def getDateWindow(self) -> tuple:
+        """
+        Gets the most restrictive date range of all "date" filters.
+
+        :return: A tuple (after, before) of dates in the format of Bungie's "period" values, None if not restricted.
+        """
+        after = None
+        before = None
+
+        for filter_data in self.filters:
+            if filter_data["type"] != "date":
+                continue
+
+            value = _to_period(filter_data["value"])
+
+            if filter_data["operator"] == "after" and (after is None or value > after):
+                after = value
+
+            if filter_data["operator"] == "before" and (before is None or value < before):
+                before = value
+
+        return after, before
+
+    def compileBatchFilter(self) -> typing.Callable[[dict], bool]:
+        """
+        Compiles the filters that can decide on a whole batch of activities.
+
+        :return: A predicate that returns whether a batch should be kept.
+        """
+        predicates = []
+
+        for filter_data in self.filters:
+            filter_type = filter_data["type"]
+            filter_op = filter_data["operator"]
+            filter_value = filter_data["value"]
+
+            if filter_type == "character":
+                predicates.append(_compile_membership(filter_op, filter_value, lambda batch: {batch["character"]}))
+
+            if filter_type == "date":
+                value = _to_period(filter_value)
+
+                # batch data is newest-first
+                if filter_op == "before":
+                    predicates.append(lambda batch, value=value: batch["data"][-1]["period"] <= value)
+
+                if filter_op == "after":
+                    predicates.append(lambda batch, value=value: batch["data"][0]["period"] >= value)
+
+        return lambda batch: all(predicate(batch) for predicate in predicates)
+
+    def compileActivityFilter(self, get_modes: typing.Callable[[dict], set] = None) -> typing.Callable[[dict], bool]:
+        """
+        Compiles the filters that decide on single activities.
+
+        :param get_modes: Returns all modes of an activity, for "activity" filters.
+                          Defaults to the modes listed in the activity itself.
+        :return: A predicate that returns whether an activity should be kept.
+        """
+        if get_modes is None:
+            get_modes = activity_modes
+
+        predicates = []
+
+        for filter_data in self.filters:
+            filter_type = filter_data["type"]
+            filter_op = filter_data["operator"]
+            filter_value = filter_data["value"]
+
+            if filter_type == "date":
+                value = _to_period(filter_value)
+
+                if filter_op == "before":
+                    predicates.append(lambda activity, value=value: activity["period"] <= value)
+
+                if filter_op == "after":
+                    predicates.append(lambda activity, value=value: activity["period"] >= value)
+
+            if filter_type == "activity":
+                predicates.append(_compile_membership(filter_op, filter_value, get_modes))
+
+        return lambda activity: all(predicate(activity) for predicate in predicates)
+
+    def compileSql(self, table: str = "activities") -> tuple:
+        """
+        Compiles the filters into an SQL condition for SqliteStore.
+
+        :param table: The name or alias of the activities table in the query.
+        :return: A tuple (condition, parameters).
+        """
+        conditions = ["1"]
+        parameters = []
+
+        for filter_data in self.filters:
+            filter_type = filter_data["type"]
+            filter_op = filter_data["operator"]
+            filter_value = filter_data["value"]
+
+            if filter_type == "date":
+                if filter_op == "before":
+                    conditions.append(table + ".period <= ?")
+                    parameters.append(_to_period(filter_value))
+
+                if filter_op == "after":
+                    conditions.append(table + ".period >= ?")
+                    parameters.append(_to_period(filter_value))
+
+            if filter_type in ("character", "activity"):
+                values = _membership_values(filter_op, filter_value)
+                placeholders = ", ".join("?" * len(values))
+                negation = "NOT " if filter_op in ("is not", "not in") else ""
+
+                if filter_type == "character":
+                    conditions.append(table + ".character " + negation + "IN (" + placeholders + ")")
+                else:
+                    conditions.append(
+                        negation + "EXISTS (SELECT 1 FROM activity_modes WHERE activity_modes.player = "
+                        + table + ".player AND activity_modes.instanceId = " + table + ".instanceId"
+                        + " AND activity_modes.mode IN (" + placeholders + "))"
+                    )
+
+                parameters.extend(values)
+
+        return " AND ".join(conditions), parameters
+
+
+def _to_period(value: str) -> str:
+    """
+    Converts an ISO date with timezone to the format Bungie uses for "period" values,
+    so they can be compared as plain strings.
+
+    :param value: A date in ISO format, with time and timezone.
+    :return: The date in UTC, in the format 2020-05-01T00:00:00Z
+    """
+    return datetime.fromisoformat(value).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def activity_modes(activity: dict, manifest: Manifest = None) -> set:
+    """
+    :param activity: An activity from the activity history.
+    :param manifest: If given, the modes the definition of the activity lists are added.
+    :return: All modes the activity counts towards.
+    """
+    details = activity["activityDetails"]
+    modes = set(details.get("modes", [])) | {details.get("mode")}
+
+    if manifest is not None:
+        modes |= manifest.get_activity_modes(Manifest.activity_hash_of(activity))
+
+    return modes
+
+
+def _compile_membership(operator: OperatorType, value, get_values) -> typing.Callable[[dict], bool]:
+    """
+    Compiles an "is", "is not", "in" or "not in" filter.
+
+    :param operator: The filter operator.
+    :param value: The filter value, a list for "in" and "not in".
+    :param get_values: Returns the set of values of an item to check against.
+    :return: A predicate that returns whether an item should be kept.
+    """
+    values = _membership_values(operator, value)
+
+    if operator in ("is", "in"):
+        return lambda item: not values.isdisjoint(get_values(item))
+
+    return lambda item: values.isdisjoint(get_values(item))
+
+
+def _membership_values(operator: OperatorType, value) -> set:
+    if operator in ("is", "is not"):
+        return {int(value)}
+
+    return {int(element) for element in value}
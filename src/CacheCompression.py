@@ -0,0 +1,100 @@
+import gzip
+import lzma
+import zlib
+
+
+class CacheCompression:
+    """
+    Compresses cache files with a codec of the standard library, see Settings.CompressCaches.
+
+    Files that are only read front to back, like the activity history, are compressed as a whole.
+    Activity details need to be read one at a time, so they are compressed each on their own, see JsonPgcrCache.
+    Those are small and share most of their keys, so "zlib" primes each of them with a dictionary of typical details.
+    """
+
+    CODECS = ["gzip", "lzma", "zlib"]
+
+    # deflate (and so "gzip" and "zlib") only looks this far back
+    MAX_DICTIONARY_SIZE = 2 ** 15
+
+    # file extension of whole compressed files, by codec
+    STREAM_EXTENSIONS = {
+        "gzip": ".gz",
+        "lzma": ".xz",
+        # whole files are large enough to not need a dictionary, so these are plain deflate as well
+        "zlib": ".gz",
+    }
+
+    # LZMA2 without the header and checksum of the .xz format, which would add up over thousands of small records.
+    # The window fits typical details, setting up a larger one for each of them takes longer than compressing them.
+    # Presets above 2 compress details several times slower, for less than a tenth smaller files.
+    LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 2, "dict_size": 2 ** 16}]
+
+    def __init__(self, codec: str, dictionary: bytes = b""):
+        """
+        :param codec: One of CODECS.
+        :param dictionary: The dictionary to prime "zlib" with, up to MAX_DICTIONARY_SIZE bytes.
+                           Has to be the same for compressing and decompressing.
+        """
+        if codec not in self.CODECS:
+            raise ValueError("Unknown cache compression: " + str(codec))
+
+        self.codec = codec
+        self.dictionary = dictionary[-self.MAX_DICTIONARY_SIZE:] if codec == "zlib" else b""
+
+    @staticmethod
+    def stream_extension(codec: str) -> str:
+        """
+        :param codec: One of CODECS, or None for no compression.
+        :return: The extension to add to the name of a whole compressed file.
+        """
+        return CacheCompression.STREAM_EXTENSIONS[codec] if codec is not None else ""
+
+    @staticmethod
+    def stream_codec_of(filename: str) -> str:
+        """
+        :param filename: A cache file.
+        :return: The codec the file is compressed with as a whole, by its extension, None if it is not.
+        """
+        if filename.endswith(".xz"):
+            return "lzma"
+
+        if filename.endswith(".gz"):
+            return "gzip"
+
+        return None
+
+    @staticmethod
+    def open_stream(filename: str, mode: str, codec: str):
+        """
+        Opens a file that is compressed as a whole.
+
+        :param filename: The file.
+        :param mode: "rb" or "wb".
+        :param codec: One of CODECS.
+        :return: A binary file object that compresses or decompresses on the fly.
+        """
+        if codec == "lzma":
+            return lzma.open(filename, mode, filters=CacheCompression.LZMA_FILTERS if "w" in mode else None)
+
+        return gzip.open(filename, mode, compresslevel=6)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == "gzip":
+            return gzip.compress(data, compresslevel=6, mtime=0)
+
+        if self.codec == "lzma":
+            return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.LZMA_FILTERS)
+
+        compressor = zlib.compressobj(6, zdict=self.dictionary) if self.dictionary else zlib.compressobj(6)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.codec == "gzip":
+            return gzip.decompress(data)
+
+        if self.codec == "lzma":
+            return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=self.LZMA_FILTERS)
+
+        decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
@@ -0,0 +1,131 @@
+import asyncio
+import sys
+from io import BytesIO
+
+import aiocurl
+
+from src.Settings import Settings
+
+
+class CurlPool:
+    """
+    A pool of reusable curl handles that share a single multi handle.
+
+    The multi handle owns the connection cache, so connections are kept alive between requests
+    and HTTP/2 streams are multiplexed over a few connections instead of doing a TLS handshake per request.
+    Has to be created and used inside a running event loop.
+    """
+
+    def __init__(self, size: int, connections: int, connect_timeout: float, timeout: float, header_list: list):
+        """
+        :param size: The maximum amount of curl handles, i.e. concurrent transfers.
+        :param connections: The maximum amount of connections per host.
+        :param connect_timeout: The maximum amount of seconds to wait for a connection.
+        :param timeout: The maximum amount of seconds a transfer may take as a whole.
+        :param header_list: The HTTP headers to send with every request.
+        """
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.header_list = header_list
+
+        self.multi = aiocurl.CurlMulti()
+        self.multi.setopt(aiocurl.M_PIPELINING, aiocurl.PIPE_MULTIPLEX)
+        self.multi.setopt(aiocurl.M_MAX_HOST_CONNECTIONS, connections)
+
+        self.handles = []
+        self.idle = asyncio.Queue()
+        # handles that have been handed to the multi handle and not given back yet, which can be stopped
+        self.transferring = set()
+
+    def _create_handle(self):
+        try:
+            handle = aiocurl.Curl()
+        except aiocurl.error as e:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sys.stderr.write("[ERROR] aiocurl.error: " + str(e) + "\n")
+            sys.stderr.write("[ERROR] curl init failed - we likely ran out of connections to use" + "\n")
+            sys.stderr.write("[ERROR] Exiting." + "\n")
+            sys.stderr.flush()
+            exit(1)
+
+        handle.setopt(aiocurl.HTTPHEADER, self.header_list)
+        handle.setopt(aiocurl.HTTP_VERSION, aiocurl.CURL_HTTP_VERSION_2TLS)
+        # wait for a connection that can be multiplexed instead of opening a new one
+        handle.setopt(aiocurl.PIPEWAIT, True)
+        handle.setopt(aiocurl.TCP_KEEPALIVE, True)
+        # a transfer that does not finish in time fails with an aiocurl.error and can be retried
+        handle.setopt(aiocurl.CONNECTTIMEOUT_MS, int(self.connect_timeout * 1000))
+        handle.setopt(aiocurl.TIMEOUT_MS, int(self.timeout * 1000))
+        handle.setopt(aiocurl.SSL_VERIFYPEER, False)
+        handle.setopt(aiocurl.FOLLOWLOCATION, True)
+        if Settings.Advanced_CurlVerbose:
+            handle.setopt(aiocurl.VERBOSE, True)
+
+        self.handles.append(handle)
+        return handle
+
+    async def _acquire(self):
+        if self.idle.empty() and len(self.handles) < self.size:
+            return self._create_handle()
+
+        return await self.idle.get()
+
+    async def _transfer(self, handle, url: str) -> tuple:
+        data = BytesIO()
+        handle.setopt(aiocurl.URL, url)
+        handle.setopt(aiocurl.WRITEFUNCTION, data.write)
+
+        # the multi handle takes the handle right away, without yielding to the event loop in between
+        self.transferring.add(handle)
+
+        try:
+            await self.multi.perform(handle)
+        finally:
+            self.transferring.discard(handle)
+
+        return handle.getinfo(aiocurl.HTTP_CODE), data.getvalue()
+
+    def _stop(self, handle) -> None:
+        try:
+            self.multi.stop(handle)
+        except (KeyError, aiocurl.error):
+            # the transfer finished in the same iteration of the event loop, so there is nothing to stop
+            pass
+
+    async def perform(self, url: str) -> tuple:
+        """
+        Does a GET request with a pooled handle.
+
+        :param url: The full URL to request.
+        :return: A tuple (status code, response body as bytes).
+        :raises aiocurl.error: If curl fails to perform the transfer.
+        :raises asyncio.CancelledError: If cancelled, in which case the transfer is stopped and the handle reused.
+        """
+        handle = await self._acquire()
+
+        transfer = asyncio.ensure_future(self._transfer(handle, url))
+        # only once the multi handle is done with it, even if cancelled
+        transfer.add_done_callback(lambda _: self.idle.put_nowait(handle))
+
+        try:
+            return await asyncio.shield(transfer)
+        except asyncio.CancelledError:
+            # stop the transfer cleanly, so the multi handle does not finish a cancelled future later
+            if handle in self.transferring:
+                self._stop(handle)
+            else:
+                transfer.cancel()
+            raise
+
+    def close(self) -> None:
+        """
+        Stops all running transfers and closes all connections and handles.
+        """
+        self.multi.close()
+
+        for handle in self.handles:
+            handle.close()
+
+        self.handles = []
@@ -0,0 +1,45 @@
+import json
+import os
+
+
+class FetchTimes:
+    """
+    Remembers when each cached artifact (clan members, activity history, ...) was last requested from Bungie,
+    in a JSON file next to the cache files, so it can be requested again once it is too old.
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: The JSON file to read from and save to.
+        """
+        self.filename = filename
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.filename):
+            return {}
+
+        with open(self.filename, "r") as f:
+            return json.load(f)
+
+    def get_fetch_time(self, artifact: str) -> float:
+        """
+        :param artifact: The name of the artifact, e.g. "activities_Foo#1234".
+        :return: When it was last requested, as Unix time, or None if that is not known.
+        """
+        return self._load().get(artifact)
+
+    def set_fetch_time(self, artifact: str, fetched: float) -> None:
+        """
+        :param artifact: The name of the artifact, e.g. "activities_Foo#1234".
+        :param fetched: When it was requested, as Unix time.
+        """
+        # read again right before writing, so times written by other runs in the meantime are kept
+        fetch_times = self._load()
+        fetch_times[artifact] = fetched
+
+        temporary_filename = self.filename + ".tmp"
+
+        with open(temporary_filename, "w") as f:
+            json.dump(fetch_times, f)
+
+        os.replace(temporary_filename, self.filename)
@@ -0,0 +1,77 @@
+from src.SlimPgcr import SlimPgcr
+
+
+class FirstMeetings:
+    """
+    Keeps track of the first activity shared with each clanmate.
+
+    Activity details have to be added oldest-first, so the first match of a clanmate is their first meeting.
+    """
+
+    def __init__(self, clanmate_index: dict, clanmate_amount: int, limit: int = 0):
+        """
+        :param clanmate_index: The clanmate lookup table, see index_clanmates().
+        :param clanmate_amount: The amount of clanmates in the index.
+        :param limit: Stop after this many clanmates were found, 0 to find all.
+        """
+        self.clanmate_index = clanmate_index
+        self.clanmate_amount = clanmate_amount
+        self.target = clanmate_amount if limit == 0 else min(limit, clanmate_amount)
+
+        # id() of the clanmate object -> [date, activity ID, activity hash, display name]
+        self.meetings = {}
+
+    def is_done(self) -> bool:
+        return len(self.meetings) >= self.target
+
+    def add(self, activity) -> bool:
+        """
+        Checks the next activity for clanmates that have not been met before.
+
+        :param activity: The activity details, with player details, as Bungie response or SlimPgcr.
+        :return: Whether every clanmate (or the limit) has been found.
+        """
+        if self.is_done():
+            return True
+
+        activity = SlimPgcr.of(activity)
+
+        for activity_player_id in activity.membership_ids:
+            match = self.clanmate_index.get(activity_player_id)
+
+            if match is None:
+                continue
+
+            [clanmate, player_name] = match
+
+            if id(clanmate) in self.meetings:
+                continue
+
+            self.meetings[id(clanmate)] = [activity.period, activity.instance_id, activity.reference_id,
+                                           player_name]
+
+            if self.is_done():
+                return True
+
+        return False
+
+    def print(self, describe_activity=None) -> None:
+        """
+        Prints the first meeting with each clanmate found so far.
+
+        :param describe_activity: Turns the activity ID and activity hash into the text to show for an activity.
+                                  Shows "Activity <ID>" if not given.
+        """
+        print("Showing first games with teammates...")
+
+        for [activity_date, activity_id, activity_hash, player_name] in self.meetings.values():
+            if describe_activity is not None:
+                activity = describe_activity(activity_id, activity_hash)
+            else:
+                activity = "Activity " + str(activity_id)
+
+            print("[" + activity_date + "] " + activity + " has clanmate " + player_name)
+
+        # if we are not done, every activity has been checked
+        if not self.is_done():
+            print("Never met " + str(self.clanmate_amount - len(self.meetings)) + " clanmates in the given activities.")
@@ -0,0 +1,117 @@
+import json
+import re
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_SEPARATOR = re.compile(r"[ \t\n\r]*([,\]])")
+
+
+class JsonArrayReader:
+    """
+    Reads the elements of a JSON array from a file one at a time,
+    so only a single element needs to be in memory instead of the whole array.
+
+    Also tells where each element is in the file, so it can be read again later on its own, see JsonPgcrCache.
+    """
+
+    CHUNK_SIZE = 2 ** 20
+
+    def __init__(self, source):
+        """
+        :param source: A file opened in binary mode, or an mmap of one, positioned at the start of the array.
+        """
+        self.source = source
+        self.decoder = json.JSONDecoder()
+
+        # the bytes are decoded as latin-1, so positions in the buffer are positions in the file,
+        # see read_elements() for how UTF-8 is handled
+        self.buffer = ""
+        self.buffer_is_ascii = True
+        self.offset = source.tell()
+        self.position = 0
+        self.eof = False
+
+    def __iter__(self):
+        for _, _, value in self.read_elements():
+            yield value
+
+    def _fill(self) -> bool:
+        """
+        Reads more of the file into the buffer, dropping what was read already.
+
+        :return: Whether anything was read, False at the end of the file.
+        """
+        if self.eof:
+            return False
+
+        self.buffer = self.buffer[self.position:]
+        self.offset += self.position
+        self.position = 0
+
+        # grows with the buffer, so elements larger than a chunk do not need to be decoded too often
+        chunk = self.source.read(max(self.CHUNK_SIZE, len(self.buffer)))
+
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer += chunk.decode("latin-1")
+        self.buffer_is_ascii = self.buffer.isascii()
+        return True
+
+    def _next_character(self) -> str:
+        """
+        :return: The next character that is not whitespace, without consuming it. Empty at the end of the file.
+        """
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self._fill():
+                return ""
+
+    def read_elements(self):
+        """
+        :return: An iterator of tuples (start, end, value), with the byte range of each element in the file.
+        :raises ValueError: If the file is not a valid JSON array.
+        """
+        if self._next_character() != "[":
+            raise ValueError("Expected a JSON array at byte " + str(self.offset + self.position))
+
+        self.position += 1
+
+        if self._next_character() == "]":
+            return
+
+        while True:
+            if self._next_character() == "":
+                raise ValueError("Unexpected end of the JSON array at byte " + str(self.offset + self.position))
+
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+
+            # a number cut off at the end of the buffer looks complete, so the separator after it needs to be read too
+            separator = _SEPARATOR.match(self.buffer, end)
+
+            if separator is None:
+                if self._fill():
+                    continue
+                raise ValueError("Expected , or ] at byte " + str(self.offset + end))
+
+            start = self.position
+
+            # latin-1 turned any multibyte UTF-8 characters in strings into several characters
+            if not self.buffer_is_ascii and not self.buffer[start:end].isascii():
+                value = json.loads(self.buffer[start:end].encode("latin-1"))
+
+            self.position = separator.end()
+
+            yield self.offset + start, self.offset + end, value
+
+            if separator.group(1) == "]":
+                return
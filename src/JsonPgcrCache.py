@@ -0,0 +1,361 @@
+import json
+import mmap
+import os
+import struct
+
+from src.CacheCompression import CacheCompression
+from src.JsonArrayReader import JsonArrayReader
+from src.SlimPgcr import SlimPgcr
+
+
+class JsonPgcrCache:
+    """
+    A cache of activity details (PGCRs) keyed by instanceId, stored in a single JSON file.
+
+    New details are appended to a JSONL journal next to the file as soon as they are added,
+    so an interrupted run loses nothing and the next run resumes from there.
+    Only the position of each details in the file or the journal is kept in memory,
+    they are read again when needed.
+
+    With compression, the cache is saved to a .pgcrz file next to the JSON file instead, see CacheCompression:
+    a header (MAGIC, the codec and the zlib dictionary), followed by the details, each compressed on their own
+    and prefixed with RECORD_HEADER, so they can still be read one at a time.
+    Either file is read, whatever the compression is set to, and converted when saving.
+    """
+
+    MAGIC = b"PGCRZ1\n"
+    DICTIONARY_LENGTH = struct.Struct(">I")
+    # instanceId, whether the details are a SlimPgcr, length of the compressed details
+    RECORD_HEADER = struct.Struct(">Q?I")
+
+    def __init__(self, filename: str, slim: bool = False, use_mmap: bool = False, compression: str = None):
+        """
+        :param filename: The JSON file to read from and save to.
+        :param slim: Whether to project all details down to SlimPgcr records.
+        :param use_mmap: Whether to memory-map the file instead of reading from it.
+        :param compression: The codec to save the cache with, one of CacheCompression.CODECS, None to save JSON.
+        """
+        plain_filename = filename
+        compressed_filename = self.compressed_filename_of(filename)
+
+        self.filename = compressed_filename if compression is not None else plain_filename
+        self.slim = slim
+        self.use_mmap = use_mmap
+        self.compression = compression
+        self.journal_filename = os.path.splitext(filename)[0] + ".journal.jsonl"
+        self.journal = None
+        self.changed = False
+
+        # the file to read from, which is the other one until the cache is saved after changing compression
+        self.source_filename = self.filename
+
+        if not os.path.exists(self.source_filename):
+            other_filename = plain_filename if compression is not None else compressed_filename
+
+            if os.path.exists(other_filename):
+                self.source_filename = other_filename
+                self.changed = True
+
+        # how the file is compressed, None for JSON
+        self.source_compression = None
+
+        # instanceId -> (start, end) of details in the file
+        self.spans = {}
+        # instanceId -> (start, end) of details in the journal
+        self.journal_spans = {}
+        # instanceId -> details that were converted to SlimPgcrs, which are only in memory until saved
+        self.pgcrs = {}
+
+        self.file = None
+        self.source = None
+
+        if os.path.exists(self.source_filename):
+            print('Read activity details from ' + self.source_filename)
+            self._open()
+
+            if self.source.read(len(self.MAGIC)) == self.MAGIC:
+                self._read_compressed_index()
+            else:
+                self.source.seek(0)
+                self._read_index()
+
+        if os.path.exists(self.journal_filename):
+            recovered = 0
+            position = 0
+            valid_end = 0
+
+            with open(self.journal_filename, "rb") as f:
+                for line in f:
+                    start = position
+                    position += len(line)
+
+                    try:
+                        details = SlimPgcr.deserialize(json.loads(line))
+                    except ValueError:
+                        # the last line might have been cut off by a crash
+                        continue
+
+                    valid_end = position
+
+                    if self.slim and not isinstance(details, SlimPgcr):
+                        self._keep(SlimPgcr.of(details))
+                    else:
+                        self._forget(SlimPgcr.instance_id_of(details))
+                        self.journal_spans[SlimPgcr.instance_id_of(details)] = (start, start + len(line.rstrip()))
+
+                    recovered += 1
+
+            # so new lines do not get appended to a cut off one
+            if valid_end < position:
+                os.truncate(self.journal_filename, valid_end)
+
+            print('Recovered ' + str(recovered) + ' activity details from ' + self.journal_filename)
+            self.changed = self.changed or recovered > 0
+
+    @staticmethod
+    def compressed_filename_of(filename: str) -> str:
+        """
+        :param filename: The JSON file of a cache.
+        :return: The file the cache is saved to with compression.
+        """
+        return os.path.splitext(filename)[0] + ".pgcrz"
+
+    def _read_index(self) -> None:
+        for start, end, value in JsonArrayReader(self.source).read_elements():
+            details = SlimPgcr.deserialize(value)
+
+            if self.slim and not isinstance(details, SlimPgcr):
+                # rewrite the file in the slim format
+                self._keep(SlimPgcr.of(details))
+                self.changed = True
+            else:
+                self.spans[SlimPgcr.instance_id_of(details)] = (start, end)
+
+    def _read_compressed_index(self) -> None:
+        codec = self.source.readline().decode("ascii").strip()
+        [dictionary_length] = self.DICTIONARY_LENGTH.unpack(self.source.read(self.DICTIONARY_LENGTH.size))
+        self.source_compression = CacheCompression(codec, self.source.read(dictionary_length))
+
+        while True:
+            header = self.source.read(self.RECORD_HEADER.size)
+
+            if len(header) < self.RECORD_HEADER.size:
+                break
+
+            [instance_id, is_slim, length] = self.RECORD_HEADER.unpack(header)
+            start = self.source.tell()
+            self.spans[str(instance_id)] = (start, start + length)
+
+            # the details of a cache that was not slim can be either
+            if self.slim and not is_slim:
+                details = SlimPgcr.deserialize(json.loads(self._get_json(str(instance_id))))
+
+                if not isinstance(details, SlimPgcr):
+                    # rewrite the file in the slim format
+                    self._keep(SlimPgcr.of(details))
+                    self.changed = True
+
+            self.source.seek(start + length)
+
+    def _open(self) -> None:
+        self.file = open(self.source_filename, "rb")
+        self.source = self.file
+
+        # an empty file can not be mapped
+        if self.use_mmap and os.path.getsize(self.source_filename) > 0:
+            self.source = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close(self) -> None:
+        if self.source is not None and self.source is not self.file:
+            self.source.close()
+
+        if self.file is not None:
+            self.file.close()
+
+        self.file = None
+        self.source = None
+
+    def _open_journal(self) -> None:
+        if self.journal is None:
+            # writes always go to the end, reads can go anywhere
+            self.journal = open(self.journal_filename, "a+b")
+
+    @staticmethod
+    def _read(source, span: tuple) -> bytes:
+        [start, end] = span
+        source.seek(start)
+        return source.read(end - start)
+
+    def _decode(self, data: bytes) -> bytes:
+        """
+        :param data: Details as read from the file.
+        :return: The details as JSON.
+        """
+        if self.source_compression is not None:
+            return self.source_compression.decompress(data)
+
+        return data
+
+    def _get_json(self, instance_id: str) -> bytes:
+        """
+        :return: The details as JSON, wherever they are.
+        """
+        if instance_id in self.spans:
+            return self._decode(self._read(self.source, self.spans[instance_id]))
+
+        if instance_id in self.journal_spans:
+            self._open_journal()
+            return self._read(self.journal, self.journal_spans[instance_id])
+
+        return json.dumps(SlimPgcr.serialize(self.pgcrs[instance_id])).encode("utf8")
+
+    def _forget(self, instance_id: str) -> None:
+        self.spans.pop(instance_id, None)
+        self.journal_spans.pop(instance_id, None)
+        self.pgcrs.pop(instance_id, None)
+
+    def _keep(self, details: SlimPgcr) -> None:
+        self._forget(details.instance_id)
+        self.pgcrs[details.instance_id] = details
+
+    def has_pgcr(self, instance_id) -> bool:
+        instance_id = str(instance_id)
+        return instance_id in self.spans or instance_id in self.journal_spans or instance_id in self.pgcrs
+
+    def get_pgcr(self, instance_id):
+        """
+        :param instance_id: The instanceId of the activity.
+        :return: The activity details, as Bungie response or SlimPgcr, or None if they are not cached.
+        """
+        instance_id = str(instance_id)
+
+        if instance_id in self.pgcrs:
+            return self.pgcrs[instance_id]
+
+        if instance_id in self.spans or instance_id in self.journal_spans:
+            return SlimPgcr.deserialize(json.loads(self._get_json(instance_id)))
+
+        return None
+
+    def put_pgcr(self, details) -> None:
+        """
+        :param details: The activity details, as Bungie response or SlimPgcr.
+        """
+        if self.slim:
+            details = SlimPgcr.of(details)
+
+        instance_id = SlimPgcr.instance_id_of(details)
+        data = json.dumps(SlimPgcr.serialize(details)).encode("utf8")
+
+        self._open_journal()
+        start = self.journal.seek(0, os.SEEK_END)
+        self.journal.write(data + b"\n")
+        self.journal.flush()
+
+        self._forget(instance_id)
+        self.journal_spans[instance_id] = (start, start + len(data))
+        self.changed = True
+
+    def _create_compression(self) -> CacheCompression:
+        """
+        :return: The compression to save the cache with. The dictionary is made of the first details in the cache,
+                 as typical details share most of their keys and values with all others.
+        """
+        dictionary = b""
+
+        if self.compression == "zlib":
+            for instance_id in [*self.spans, *self.journal_spans, *self.pgcrs]:
+                if len(dictionary) >= CacheCompression.MAX_DICTIONARY_SIZE:
+                    break
+
+                dictionary += self._get_json(instance_id)
+
+        return CacheCompression(self.compression, dictionary)
+
+    def save(self) -> None:
+        """
+        Writes the cache to its file, if anything was added, and clears the journal.
+        Details are copied over from the old file and the journal without decoding them,
+        unless they need to be compressed differently.
+        """
+        if not self.changed:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+            return
+
+        self._open_journal()
+
+        compression = None
+        # whether the details in the file can be copied over as they are
+        keep_encoding = self.source_compression is None and self.compression is None
+
+        if self.compression is not None:
+            if self.source_compression is not None and self.source_compression.codec == self.compression:
+                compression = self.source_compression
+                keep_encoding = True
+            else:
+                compression = self._create_compression()
+
+        # write to a temporary file first, so a crash can not leave a half-written cache behind
+        temporary_filename = self.filename + ".tmp"
+        spans = {}
+
+        with open(temporary_filename, "wb") as f:
+            if compression is not None:
+                f.write(self.MAGIC + compression.codec.encode("ascii") + b"\n")
+                f.write(self.DICTIONARY_LENGTH.pack(len(compression.dictionary)) + compression.dictionary)
+            else:
+                f.write(b"[")
+
+            def write(instance_id: str, data: bytes, is_slim: bool, encoded: bool = False) -> None:
+                if compression is not None:
+                    if not encoded:
+                        data = compression.compress(data)
+
+                    f.write(self.RECORD_HEADER.pack(int(instance_id), is_slim, len(data)))
+                elif len(spans) > 0:
+                    f.write(b", ")
+
+                spans[instance_id] = (f.tell(), f.tell() + len(data))
+                f.write(data)
+
+            for instance_id, span in self.spans.items():
+                if keep_encoding:
+                    data = self._read(self.source, span)
+                    write(instance_id, data, self.slim, encoded=True)
+                else:
+                    write(instance_id, self._get_json(instance_id), self.slim)
+
+            for instance_id, span in self.journal_spans.items():
+                write(instance_id, self._read(self.journal, span), self.slim)
+
+            for instance_id, details in self.pgcrs.items():
+                write(instance_id, json.dumps(SlimPgcr.serialize(details)).encode("utf8"), True)
+
+            if compression is None:
+                f.write(b"]")
+
+        self._close()
+        self.journal.close()
+        self.journal = None
+
+        os.replace(temporary_filename, self.filename)
+        print('Saved activity details to ' + self.filename)
+
+        if self.source_filename != self.filename and os.path.exists(self.source_filename):
+            os.remove(self.source_filename)
+            print('Removed ' + self.source_filename + ', which was converted to ' + self.filename)
+
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+
+        self.spans = spans
+        self.journal_spans = {}
+        self.pgcrs = {}
+        self.source_filename = self.filename
+        self.source_compression = compression
+        self._open()
+
+        self.changed = False
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+
+
+class Manifest:
+    """
+    An index of the definitions in a Destiny manifest (the SQLite content database Bungie provides),
+    to tell what an activity was without requesting its PGCR.
+
+    Only the few fields that are needed are kept, so the index is loaded once and stays small.
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: The manifest content database, e.g. world_sql_content_*.content.
+        :raises sqlite3.DatabaseError: If the file is not a manifest.
+        """
+        self.filename = filename
+
+        # activity hash -> (name, direct mode, modes)
+        self.activities = {}
+        # mode type -> name
+        self.mode_names = {}
+        # class type -> name
+        self.class_names = {}
+
+        connection = sqlite3.connect("file:" + filename + "?mode=ro", uri=True)
+
+        try:
+            for definition in self._definitions(connection, "DestinyActivityDefinition"):
+                mode = definition.get("directActivityModeType")
+                modes = set(definition.get("activityModeTypes") or [])
+
+                if mode is not None:
+                    modes.add(mode)
+
+                self.activities[definition["hash"]] = (self._name_of(definition), mode, frozenset(modes))
+
+            for definition in self._definitions(connection, "DestinyActivityModeDefinition"):
+                self.mode_names.setdefault(definition.get("modeType"), self._name_of(definition))
+
+            for definition in self._definitions(connection, "DestinyClassDefinition"):
+                self.class_names[definition.get("classType")] = self._name_of(definition)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _definitions(connection: sqlite3.Connection, table: str):
+        for (data,) in connection.execute("SELECT json FROM " + table):
+            yield json.loads(data)
+
+    @staticmethod
+    def _name_of(definition: dict):
+        return definition.get("displayProperties", {}).get("name") or None
+
+    @staticmethod
+    def activity_hash_of(activity) -> int:
+        """
+        :param activity: An activity from the activity history or activity details.
+        :return: The hash of the activity definition, None if there is none.
+        """
+        details = activity["activityDetails"]
+        activity_hash = details.get("referenceId") or details.get("directorActivityHash")
+
+        return int(activity_hash) if activity_hash is not None else None
+
+    def get_activity_name(self, activity_hash):
+        """
+        :param activity_hash: The referenceId or directorActivityHash of an activity.
+        :return: The name of the activity, e.g. "Vault of Glass", None if it is unknown.
+        """
+        return self.activities.get(activity_hash, (None, None, None))[0]
+
+    def get_activity_modes(self, activity_hash) -> frozenset:
+        """
+        :param activity_hash: The referenceId or directorActivityHash of an activity.
+        :return: All modes the activity counts towards, see aiobungie.GameMode. Empty if the activity is unknown.
+        """
+        return self.activities.get(activity_hash, (None, None, frozenset()))[2]
+
+    def get_activity_label(self, activity_hash):
+        """
+        :param activity_hash: The referenceId or directorActivityHash of an activity.
+        :return: The name of the activity with the name of its mode, e.g. "Raid: Vault of Glass",
+                 None if the activity is unknown.
+        """
+        name, mode, _ = self.activities.get(activity_hash, (None, None, None))
+        mode_name = self.mode_names.get(mode)
+
+        if name is None or mode_name is None or mode_name == name:
+            return name
+
+        return mode_name + ": " + name
+
+    def get_class_name(self, class_type):
+        """
+        :param class_type: A class type, see aiobungie.Class.
+        :return: The name of the class, e.g. "Titan", None if it is unknown.
+        """
+        return self.class_names.get(class_type)
@@ -0,0 +1,309 @@
+import os
+import re
+import threading
+import time
+
+from src.RateLimiter import RateLimiter
+
+
+class Metrics:
+    """
+    Collects telemetry of all requests to the Bungie API:
+    latencies, bytes, status and error codes, retries and throttling.
+
+    Can print a summary line periodically and write everything to a file in the Prometheus text format.
+    Reporting runs on its own thread, so it keeps going even if all requests hang.
+    """
+
+    # endpoint label, pattern of the URL
+    ENDPOINTS = [
+        ("pgcr", re.compile(r"/PostGameCarnageReport/")),
+        ("activities", re.compile(r"/Stats/Activities/")),
+        ("linked_profiles", re.compile(r"/LinkedProfiles/")),
+        ("search", re.compile(r"/SearchDestinyPlayer")),
+        ("profile", re.compile(r"/Profile/")),
+        ("clan_members", re.compile(r"/GroupV2/\d+/Members/")),
+        ("clan", re.compile(r"/GroupV2/")),
+    ]
+
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    # latency_quantile() needs this many earlier requests to go by
+    MIN_LATENCY_SAMPLES = 50
+
+    def __init__(self, rate_limiter: RateLimiter):
+        """
+        :param rate_limiter: The rate limiter the requests go through, to report its rate and pauses.
+        """
+        self.rate_limiter = rate_limiter
+
+        self.started_at = time.monotonic()
+        self.latencies = {}
+        # time until requests were cancelled, which would have taken at least that long, see latency_quantile()
+        self.cancelled_latencies = {}
+        self.bytes_received = {}
+        self.status_codes = {}
+        self.error_codes = {}
+        self.retries = {}
+        self.failed_requests = 0
+        self.in_flight = {}
+
+        # (quantile, endpoint) -> (amount of samples, value), see latency_quantile()
+        self.quantile_cache = {}
+
+        self.reporter = None
+        self.stop_reporting_event = threading.Event()
+
+    @staticmethod
+    def endpoint_of(url: str) -> str:
+        for endpoint, pattern in Metrics.ENDPOINTS:
+            if pattern.search(url):
+                return endpoint
+
+        return "other"
+
+    def request_started(self, url: str) -> tuple:
+        """
+        :param url: The URL that is requested.
+        :return: A token to pass to request_finished() or request_failed().
+        """
+        token = (self.endpoint_of(url), time.monotonic(), object())
+        self.in_flight[token] = True
+        return token
+
+    def request_finished(self, token: tuple, status_code: int, data, size: int) -> None:
+        """
+        :param token: The token returned by request_started().
+        :param status_code: The HTTP status code of the response.
+        :param data: The decoded Bungie response, or None if the body was not JSON.
+        :param size: The size of the response body in bytes.
+        """
+        endpoint, started, _ = token
+        self.in_flight.pop(token, None)
+
+        self.latencies.setdefault(endpoint, []).append(time.monotonic() - started)
+        self.bytes_received[endpoint] = self.bytes_received.get(endpoint, 0) + size
+
+        key = (endpoint, str(status_code))
+        self.status_codes[key] = self.status_codes.get(key, 0) + 1
+
+        if isinstance(data, dict) and "ErrorCode" in data:
+            error_code = str(data["ErrorCode"])
+            self.error_codes[error_code] = self.error_codes.get(error_code, 0) + 1
+
+    def request_failed(self, token: tuple) -> None:
+        """
+        Reports a request that did not get a response at all.
+
+        :param token: The token returned by request_started().
+        """
+        self.in_flight.pop(token, None)
+        self.failed_requests += 1
+
+    def request_cancelled(self, token: tuple) -> None:
+        """
+        Reports a request that was given up on, e.g. the slower one of a hedged request.
+
+        :param token: The token returned by request_started().
+        """
+        endpoint, started, _ = token
+        self.in_flight.pop(token, None)
+
+        self.cancelled_latencies.setdefault(endpoint, []).append(time.monotonic() - started)
+
+    def retried(self, reason: str) -> None:
+        """
+        :param reason: Why the request is retried, e.g. "throttle".
+        """
+        self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def request_count(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    @staticmethod
+    def quantile(sorted_values: list, quantile: float) -> float:
+        if len(sorted_values) == 0:
+            return 0.0
+
+        return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+    def latency_quantile(self, url: str, quantile: float):
+        """
+        Gets a latency quantile of the earlier requests to the same endpoint.
+        It is only recalculated once the amount of samples has grown by a tenth, as that needs sorting them.
+
+        Cancelled requests count with the time until they were cancelled, as they would have taken at least that long.
+        Leaving them out would only leave the faster requests, so the quantile would drop the more requests are hedged.
+
+        :param url: A URL of the endpoint.
+        :param quantile: The quantile, e.g. 0.95.
+        :return: The latency in seconds, None if there were not enough requests to tell yet.
+        """
+        endpoint = self.endpoint_of(url)
+        latencies = self.latencies.get(endpoint, [])
+        cancelled_latencies = self.cancelled_latencies.get(endpoint, [])
+        samples = len(latencies) + len(cancelled_latencies)
+
+        if samples < self.MIN_LATENCY_SAMPLES:
+            return None
+
+        key = (quantile, endpoint)
+        cached = self.quantile_cache.get(key)
+
+        if cached is None or samples >= cached[0] * 1.1:
+            cached = (samples, self.quantile(sorted(latencies + cancelled_latencies), quantile))
+            self.quantile_cache[key] = cached
+
+        return cached[1]
+
+    def summary(self) -> str:
+        """
+        :return: A single line summing up all requests so far.
+        """
+        elapsed = max(time.monotonic() - self.started_at, 0.001)
+        count = self.request_count()
+        latencies = sorted(latency for values in list(self.latencies.values()) for latency in values)
+
+        line = "[METRICS] {} requests ({:.1f}/s), latency p50 {:.0f} ms, p90 {:.0f} ms, p99 {:.0f} ms".format(
+            count, count / elapsed,
+            self.quantile(latencies, 0.5) * 1000, self.quantile(latencies, 0.9) * 1000,
+            self.quantile(latencies, 0.99) * 1000
+        )
+
+        line += ", {:.1f} MiB, {} retries, {} failed, {:.0f} s paused, rate {:.1f}/s".format(
+            sum(self.bytes_received.values()) / 2 ** 20, sum(self.retries.values()), self.failed_requests,
+            self.rate_limiter.paused_seconds, self.rate_limiter.rate
+        )
+
+        in_flight = list(self.in_flight)
+        if len(in_flight) > 0:
+            oldest = time.monotonic() - min(started for (_, started, _) in in_flight)
+            line += ", {} in flight (oldest {:.0f} s)".format(len(in_flight), oldest)
+
+        errors = {code: amount for code, amount in list(self.error_codes.items()) if code != "1"}
+        if len(errors) > 0:
+            line += ", ErrorCodes " + ", ".join(code + ": " + str(amount) for code, amount in sorted(errors.items()))
+
+        return line
+
+    def to_prometheus(self) -> str:
+        """
+        :return: All metrics in the Prometheus text format.
+        """
+        lines = [
+            "# HELP destinyfatefinder_request_duration_seconds Latency of requests to the Bungie API, "
+            "including the wait for a free connection.",
+            "# TYPE destinyfatefinder_request_duration_seconds summary",
+        ]
+
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            for quantile in self.QUANTILES:
+                lines.append(
+                    'destinyfatefinder_request_duration_seconds{{endpoint="{}",quantile="{}"}} {:.6f}'.format(
+                        endpoint, quantile, self.quantile(values, quantile)))
+            lines.append('destinyfatefinder_request_duration_seconds_sum{{endpoint="{}"}} {:.6f}'.format(
+                endpoint, sum(values)))
+            lines.append('destinyfatefinder_request_duration_seconds_count{{endpoint="{}"}} {}'.format(
+                endpoint, len(values)))
+
+        lines += [
+            "# HELP destinyfatefinder_responses_total Responses from the Bungie API by HTTP status code.",
+            "# TYPE destinyfatefinder_responses_total counter",
+        ]
+        for (endpoint, status_code), amount in sorted(self.status_codes.items()):
+            lines.append('destinyfatefinder_responses_total{{endpoint="{}",status="{}"}} {}'.format(
+                endpoint, status_code, amount))
+
+        lines += [
+            "# HELP destinyfatefinder_error_codes_total Responses from the Bungie API by PlatformErrorCode.",
+            "# TYPE destinyfatefinder_error_codes_total counter",
+        ]
+        for error_code, amount in sorted(self.error_codes.items()):
+            lines.append('destinyfatefinder_error_codes_total{{error_code="{}"}} {}'.format(error_code, amount))
+
+        lines += [
+            "# HELP destinyfatefinder_received_bytes_total Bytes of response bodies received from the Bungie API.",
+            "# TYPE destinyfatefinder_received_bytes_total counter",
+        ]
+        for endpoint, size in sorted(self.bytes_received.items()):
+            lines.append('destinyfatefinder_received_bytes_total{{endpoint="{}"}} {}'.format(endpoint, size))
+
+        lines += [
+            "# HELP destinyfatefinder_retries_total Requests that were repeated.",
+            "# TYPE destinyfatefinder_retries_total counter",
+        ]
+        for reason, amount in sorted(self.retries.items()):
+            lines.append('destinyfatefinder_retries_total{{reason="{}"}} {}'.format(reason, amount))
+
+        lines += [
+            "# HELP destinyfatefinder_failed_requests_total Requests that failed without a response.",
+            "# TYPE destinyfatefinder_failed_requests_total counter",
+            "destinyfatefinder_failed_requests_total {}".format(self.failed_requests),
+            "# HELP destinyfatefinder_throttled_seconds_total Seconds requests were paused for because of throttling.",
+            "# TYPE destinyfatefinder_throttled_seconds_total counter",
+            "destinyfatefinder_throttled_seconds_total {:.3f}".format(self.rate_limiter.paused_seconds),
+            "# HELP destinyfatefinder_request_rate Current request rate limit, in requests per second.",
+            "# TYPE destinyfatefinder_request_rate gauge",
+            "destinyfatefinder_request_rate {:.3f}".format(self.rate_limiter.rate),
+            "# HELP destinyfatefinder_requests_in_flight Requests that have been started but not finished yet.",
+            "# TYPE destinyfatefinder_requests_in_flight gauge",
+            "destinyfatefinder_requests_in_flight {}".format(len(self.in_flight)),
+        ]
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str) -> None:
+        """
+        Writes all metrics to a file in the Prometheus text format, replacing it as a whole.
+
+        :param filename: The file to write to.
+        """
+        temporary_filename = filename + ".tmp"
+
+        with open(temporary_filename, "w") as f:
+            f.write(self.to_prometheus())
+
+        os.replace(temporary_filename, filename)
+
+    def start_reporting(self, interval: float, filename: str = None) -> None:
+        """
+        Prints a summary line and writes the metrics file every few seconds, until stop_reporting() is called.
+
+        :param interval: The amount of seconds between reports, 0 to not report periodically.
+        :param filename: The metrics file to write, None to not write one.
+        """
+        self.started_at = time.monotonic()
+
+        if interval <= 0:
+            return
+
+        def report():
+            while not self.stop_reporting_event.wait(interval):
+                if self.request_count() > 0 or len(self.in_flight) > 0:
+                    print(self.summary())
+
+                if filename is not None:
+                    self.write(filename)
+
+        self.stop_reporting_event.clear()
+        self.reporter = threading.Thread(target=report, daemon=True)
+        self.reporter.start()
+
+    def stop_reporting(self, filename: str = None) -> None:
+        """
+        Stops periodic reporting, then prints a final summary line and writes the metrics file.
+
+        :param filename: The metrics file to write, None to not write one.
+        """
+        if self.reporter is not None:
+            self.stop_reporting_event.set()
+            self.reporter.join()
+            self.reporter = None
+
+        if self.request_count() > 0:
+            print(self.summary())
+
+        if filename is not None:
+            self.write(filename)
+            print("Saved request metrics to " + filename)
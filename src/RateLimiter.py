@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    An adaptive (AIMD) rate limiter shared by all requests to the Bungie API.
+
+    Requests are spaced out to the current rate. Every clean response raises the rate a little,
+    up to the configured maximum, while throttle hints halve it and pause all requests for the time Bungie asks for.
+    Works from both coroutines (acquire) and blocking code (wait).
+    """
+
+    # PlatformErrorCodes that Bungie uses to tell us to slow down
+    THROTTLE_ERROR_CODES = {
+        35,  # ThrottleLimitExceeded
+        36,  # ThrottleLimitExceededMinutes
+        37,  # ThrottleLimitExceededMomentarily
+        38,  # ThrottleLimitExceededSeconds
+        51,  # PerEndpointRequestThrottleExceeded
+        52,  # PerApplicationThrottleExceeded
+        53,  # PerApplicationAnonymousThrottleExceeded
+        54,  # PerApplicationAuthenticatedThrottleExceeded
+        55,  # PerUserThrottleExceeded
+        1672,  # DestinyThrottledByGameServer
+    }
+
+    MIN_RATE = 0.5
+    INCREASE = 0.1
+    DECREASE = 0.5
+    # throttled responses that were in flight together only lower the rate once
+    DECREASE_COOLDOWN = 1.0
+
+    def __init__(self, max_rate: float = 25.0):
+        """
+        :param max_rate: The maximum amount of requests per second.
+        """
+        self.max_rate = max_rate
+        self.rate = max_rate
+
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+
+        # total amount of seconds all requests have been paused for
+        self.paused_seconds = 0.0
+
+    def set_max_rate(self, max_rate: float) -> None:
+        self.max_rate = max_rate
+        self.rate = max_rate
+
+    def _reserve(self) -> float:
+        """
+        Reserves the next free request slot.
+
+        :return: The amount of seconds to wait until the slot is reached.
+        """
+        now = time.monotonic()
+        slot = max(now, self.next_slot, self.paused_until)
+        self.next_slot = slot + 1.0 / self.rate
+        return slot - now
+
+    async def acquire(self) -> None:
+        """
+        Waits until the next request may be started, without blocking the event loop.
+        """
+        delay = self._reserve()
+
+        # a throttle hint might have come in while we waited
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.paused_until - time.monotonic()
+
+    def wait(self) -> None:
+        """
+        Blocking version of acquire() for synchronous requests.
+        """
+        delay = self._reserve()
+
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.paused_until - time.monotonic()
+
+    def success(self) -> None:
+        """
+        Reports a clean response, raising the rate additively.
+        """
+        self.rate = min(self.max_rate, self.rate + self.INCREASE)
+
+    def decrease(self) -> None:
+        """
+        Lowers the rate multiplicatively. Responses that were already in flight
+        when the rate was lowered do not lower it again.
+        """
+        now = time.monotonic()
+
+        if now - self.last_decrease < self.DECREASE_COOLDOWN:
+            return
+
+        self.last_decrease = now
+        self.rate = max(self.MIN_RATE, self.rate * self.DECREASE)
+
+    def throttle(self, seconds: float) -> None:
+        """
+        Reports a throttle hint: pauses all requests for the given amount of seconds and lowers the rate.
+
+        :param seconds: The amount of seconds Bungie wants us to wait.
+        """
+        now = time.monotonic()
+        paused_until = now + seconds
+
+        if paused_until > self.paused_until:
+            print("Pausing requests for {} seconds because Bungie told us to".format(seconds))
+            self.paused_seconds += paused_until - max(now, self.paused_until)
+            self.paused_until = paused_until
+
+        self.decrease()
+
+    def report(self, status_code: int, data) -> bool:
+        """
+        Feeds a response into the limiter.
+
+        :param status_code: The HTTP status code of the response.
+        :param data: The decoded Bungie response, or None if the body was not JSON.
+        :return: Whether the request was rejected because of throttling and should be retried.
+        """
+        throttle_seconds = 0
+        error_code = None
+
+        if isinstance(data, dict):
+            throttle_seconds = data.get("ThrottleSeconds", 0) or 0
+            error_code = data.get("ErrorCode")
+
+        if status_code == 429 or error_code in self.THROTTLE_ERROR_CODES:
+            self.throttle(max(throttle_seconds, 1))
+            return True
+
+        if throttle_seconds > 0:
+            self.throttle(throttle_seconds)
+        elif status_code == 200:
+            self.success()
+
+        return False
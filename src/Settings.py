@@ -4,6 +4,7 @@ import sys
 import aiobungie.crate
 
 from src.ActivityFilterList import ActivityFilterList
+from src.CacheCompression import CacheCompression
 
 
 class Settings:
@@ -17,14 +18,53 @@ class Settings:
     RequeryActivityBatches: bool = None
     RequeryActivityDetails: bool = None
 
+    ClanmatesMaxAgeHours: float = 24.0
+    ActivityBatchesMaxAgeHours: float = 1.0
+
     OnlyListFirstN: int = 0
+    OnlyFirstMeetings: bool = False
+
+    BatchPlayers = None
 
     Filters = ActivityFilterList()
 
+    SkipSoloActivities: bool = True
+    PrioritizedActivityModes: list = [
+        aiobungie.GameMode.RAID,
+        aiobungie.GameMode.DUNGEON,
+        aiobungie.GameMode.STRIKE,
+    ]
+
+    UseSqliteStore: bool = False
+    SlimActivityDetails: bool = False
+
+    CompressCaches: str = None
+
+    SharedActivityDetails: bool = False
+    SharedActivityDetailsMaxMegabytes: float = None
+
+    UseManifest: bool = False
+    ManifestFile: str = None
+    ManifestLanguage: str = "en"
+
     # ADVANCED
 
     Advanced_AsyncThreadAmount: int = 10
+    Advanced_ConnectionPoolSize: int = 2
+    Advanced_MaxRequestsPerSecond: float = 25.0
+    Advanced_HistoryPrefetchPages: int = 2
+    Advanced_MemoryMapCaches: bool = False
+    Advanced_ConnectTimeout: float = 10.0
+    Advanced_RequestTimeout: float = 60.0
+    Advanced_MaxRetries: int = 5
+    Advanced_MaxThrottleRetries: int = 50
+    Advanced_HedgeQuantile: float = None
     Advanced_CurlVerbose: bool = False
+    Advanced_MetricsInterval: float = 60.0
+    Advanced_MetricsFile: str = None
+    Advanced_ApiRoot: str = "https://www.bungie.net/platform"
+    Advanced_StatsRoot: str = "https://stats.bungie.net/Platform"
+    Advanced_ContentRoot: str = "https://www.bungie.net"
 
     DataFolder: str = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'data')
 
@@ -38,7 +78,7 @@ class Settings:
             sys.stderr.write("API Key was not set." + "\n")
             is_valid = False
 
-        if Settings.BungieName is None:
+        if Settings.BungieName is None and Settings.BatchPlayers is None:
             sys.stderr.write("Player Bungie Name was not set." + "\n")
             is_valid = False
 
@@ -46,6 +86,11 @@ class Settings:
             sys.stderr.write("Clan ID was not set." + "\n")
             is_valid = False
 
+        if Settings.CompressCaches is not None and Settings.CompressCaches not in CacheCompression.CODECS:
+            sys.stderr.write("Unknown cache compression: " + str(Settings.CompressCaches) + ", use one of "
+                             + ", ".join(CacheCompression.CODECS) + "\n")
+            is_valid = False
+
         if not is_valid:
             print("Validation failed. Exiting.")
             exit(1)
@@ -102,11 +147,34 @@ def init():
     # TODO
     Settings.ClanId = None
     
+    ## run for several players at once, instead of the player above
+    ## activity details are shared, so this is a lot cheaper than running for each player on their own
+    ## either a list of Bungie Names, or "clan" to run for the whole clan
+    ## the activity history of each player is cached under their membershipId, as display names are not unique
+    # Settings.BatchPlayers = ["Foo#1234", "Bar#5678"]
+    # Settings.BatchPlayers = "clan"
+    
     ## requery these things from Bungie?
-    ## if no, try to get from cache
-    Settings.RequeryClanmates = True
-    Settings.RequeryActivityBatches = True
-    Settings.RequeryActivityDetails = True  # this is costly!
+    ## True to always request them, False to only read them from cache,
+    ## None to request them when they are not cached yet or older than the max age below
+    ## default: None
+    # Settings.RequeryClanmates = None
+    
+    ## after the first run, this only requests activities that are newer than the cached ones
+    ## with None, the history is also requested again when it does not cover the "date" filters it was cached with
+    ## default: None
+    # Settings.RequeryActivityBatches = None
+    
+    ## activity details never change, so this only requests the ones missing from the cache, unless it is False
+    ## the first run is costly!
+    ## default: None
+    # Settings.RequeryActivityDetails = None
+    
+    ## how many hours cached clan members and activity history are used for before they are requested again,
+    ## when their Requery setting above is None; None to use them for as long as they are cached
+    ## default: 24 and 1
+    # Settings.ClanmatesMaxAgeHours = 24
+    # Settings.ActivityBatchesMaxAgeHours = 1
     
     ## add filtering options
     ## see method docstring for hints
@@ -118,29 +186,145 @@ def init():
     # Settings.Filters.addFilter("character", "is", aiobungie.Class.WARLOCK)
     
     ## filter by activity
-    ## currently broken
     # Settings.Filters.addFilter("activity", "is", aiobungie.GameMode.ALLPVE)
     
     ## only list first n matches, 0 to list all
     Settings.OnlyListFirstN = 0
     
+    ## only list the first meeting with each clanmate
+    ## this requests PGCRs oldest-first and stops as soon as every clanmate
+    ## (or the first n of them, see above) has been found
+    Settings.OnlyFirstMeetings = False
+    
+    ## do not request details of activities that had no other players in them, like solo patrols
+    ## these can not contain clanmates, so this only saves requests
+    ## default: True
+    # Settings.SkipSoloActivities = True
+    
+    ## request details of activities with these modes first, as they usually have fireteams in them
+    ## has no effect with OnlyFirstMeetings, which needs to request oldest-first
+    ## default: raids, dungeons and strikes
+    # Settings.PrioritizedActivityModes = [aiobungie.GameMode.RAID, aiobungie.GameMode.DUNGEON]
+    
     ## sets folder for data
     ## default: ./data
     # Settings.DataFolder = '/home/foo/destiny/data'
     
+    ## store everything in an SQLite database in the data folder instead of the JSON files
+    ## recommended for long activity histories, as nothing needs to be loaded into memory as a whole
+    ## default: False
+    # Settings.UseSqliteStore = False
+    
+    ## only keep the parts of activity details that are needed to find clanmates
+    ## this makes the activity details cache a lot smaller, but drops stats, weapons etc. for good
+    ## default: False
+    # Settings.SlimActivityDetails = False
+    
+    ## compress the activity history and activity details caches with one of "gzip", "lzma" or "zlib", None to not
+    ## activity details repeat the same keys over and over, so they get several times smaller
+    ## "zlib" compresses best, "gzip" is a little faster, "lzma" is the slowest
+    ## caches saved with another setting are still read, and converted the next time they are saved
+    ## default: None
+    # Settings.CompressCaches = "zlib"
+    
+    ## keep activity details in a folder in the data folder that all players share, with a file per activity,
+    ## instead of a file per player
+    ## activities that were requested for any player, e.g. by a clanmate sharing the data folder, are not requested again
+    ## details in the players_*.json files are not carried over
+    ## the SQLite store keeps every activity once for all players anyway
+    ## default: False
+    # Settings.SharedActivityDetails = False
+    
+    ## size limit of the shared activity details in MB, None for no limit
+    ## when exceeded, the activity details that were used least recently are removed at the end of a run
+    ## default: None
+    # Settings.SharedActivityDetailsMaxMegabytes = 2000
+    
+    ## use the Destiny manifest to tell activities apart without requesting their details
+    ## results then show the name of each activity, and "activity" filters and PrioritizedActivityModes
+    ## also match the modes the definition of an activity lists
+    ## the manifest is downloaded to the data folder once per version (about 100 MB)
+    ## with the SQLite store, only activities stored after turning this on are filtered by those modes
+    ## default: False
+    # Settings.UseManifest = False
+    
+    ## use this manifest content database instead of downloading one
+    ## default: None
+    # Settings.ManifestFile = '/home/foo/destiny/world_sql_content.content'
+    
+    ## language of the downloaded manifest, which the names are shown in
+    ## default: "en"
+    # Settings.ManifestLanguage = "en"
+    
     #####################
     ## ADVANCED OPTIONS
     #####################
     
-    ## This controls the chunk sizes of the async requests.
+    ## This controls how many async requests are in flight at the same time.
     ## Larger values are faster, but dangerous and could get you temporarily blocked by the Bungie API.
     ## default = 10
     # Settings.Advanced_AsyncThreadAmount = 10
     
+    ## The amount of kept-alive connections to Bungie that the async requests are multiplexed over.
+    ## default = 2
+    # Settings.Advanced_ConnectionPoolSize = 2
+    
+    ## Upper limit for the request rate to Bungie.
+    ## The actual rate adapts on its own: it slows down when Bungie throttles us and speeds back up on clean responses.
+    ## default = 25
+    # Settings.Advanced_MaxRequestsPerSecond = 25
+    
+    ## Activity history pages of all characters are requested concurrently.
+    ## This controls how many pages per character are requested ahead of time.
+    ## default = 2
+    # Settings.Advanced_HistoryPrefetchPages = 2
+    
+    ## The JSON cache files are read one activity (or set of activity details) at a time, so they never need to fit
+    ## into memory as a whole. This memory-maps them instead of reading them, which lets the operating system
+    ## share and cache the pages, but makes them count towards the memory use of the program.
+    ## default = False
+    # Settings.Advanced_MemoryMapCaches = False
+    
+    ## Requests that take longer than this many seconds to connect, or to finish as a whole, are given up and retried.
+    ## default = 10 and 60
+    # Settings.Advanced_ConnectTimeout = 10
+    # Settings.Advanced_RequestTimeout = 60
+    
+    ## How often to retry a failed request before giving up, waiting longer (with some randomness) after each failure.
+    ## Being throttled by Bungie is counted separately, see below.
+    ## default = 5
+    # Settings.Advanced_MaxRetries = 5
+    
+    ## How often to retry a request that Bungie throttled before giving up.
+    ## Every throttled request slows down all requests, and waits as long as Bungie asks for.
+    ## default = 50
+    # Settings.Advanced_MaxThrottleRetries = 50
+    
+    ## If a request takes longer than this quantile of the earlier requests, a second one is started
+    ## and whichever answers first is taken, so a few slow requests can not hold up everything.
+    ## e.g. 0.95 duplicates the slowest 5% of requests. None to never duplicate requests.
+    ## default = None
+    # Settings.Advanced_HedgeQuantile = 0.95
+    
     ## Make curl give verbose output.
     ## this generates a *lot* of text - for an average set of requests, this will generate around 100k lines of output
     ## default = false
     # Settings.Advanced_CurlVerbose = False
+    
+    ## Print a summary of all requests so far (rate, latencies, throttling, retries, ...) every n seconds.
+    ## 0 to only print it once at the end.
+    ## default = 60
+    # Settings.Advanced_MetricsInterval = 60
+    
+    ## Also write request metrics to this file, in the Prometheus text format.
+    ## It is updated every Advanced_MetricsInterval seconds.
+    ## default = None
+    # Settings.Advanced_MetricsFile = '/home/foo/destiny/metrics.prom'
+    
+    ## Where to send requests to. Only change these to use a proxy or a stand-in server, see benchmarks/.
+    # Settings.Advanced_ApiRoot = "https://www.bungie.net/platform"
+    # Settings.Advanced_StatsRoot = "https://stats.bungie.net/Platform"
+    # Settings.Advanced_ContentRoot = "https://www.bungie.net"
     """
             f.write(stub)
             f.close()
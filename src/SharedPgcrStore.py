@@ -0,0 +1,156 @@
+import json
+import os
+
+from src.SlimPgcr import SlimPgcr
+
+
+class SharedPgcrStore:
+    """
+    A cache of activity details (PGCRs) that is shared by all players, with a file per instanceId in a folder.
+
+    Any run for any player can use what an earlier run requested, so several people running against the same clan
+    only request each activity once, as long as they share the data folder.
+    Reading details marks them as used, and with a size limit the least recently used ones are removed when saving.
+    Implements the PGCR cache interface of JsonPgcrCache.
+    """
+
+    def __init__(self, folder: str, slim: bool = False, max_bytes: int = None):
+        """
+        :param folder: The folder to store the details in.
+        :param slim: Whether to project new details down to SlimPgcr records.
+        :param max_bytes: The size the folder should be kept below, None for no limit.
+        """
+        self.folder = folder
+        self.slim = slim
+        self.max_bytes = max_bytes
+
+        # instanceIds used by this run, which are never removed to make space
+        self.used = set()
+        # subfolders that are known to exist
+        self.shards = set()
+
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, instance_id) -> str:
+        instance_id = str(instance_id)
+
+        if not instance_id.isdigit():
+            raise ValueError("Invalid instanceId: " + instance_id)
+
+        # spread over a hundred folders, as many file systems are slow with a lot of files in one folder
+        return os.path.join(self.folder, instance_id[-2:], instance_id + ".json")
+
+    def has_pgcr(self, instance_id) -> bool:
+        # marks the details as recently used, so other runs do not remove them before they are read
+        try:
+            os.utime(self._path(instance_id))
+        except FileNotFoundError:
+            return False
+
+        self.used.add(str(instance_id))
+        return True
+
+    def get_pgcr(self, instance_id):
+        """
+        :param instance_id: The instanceId of the activity.
+        :return: The activity details, as Bungie response or SlimPgcr, or None if they are not stored.
+                 Other runs might remove details to make space, even after has_pgcr() found them.
+        """
+        path = self._path(instance_id)
+
+        try:
+            with open(path, "rb") as f:
+                details = SlimPgcr.deserialize(json.load(f))
+        except FileNotFoundError:
+            return None
+
+        self.used.add(str(instance_id))
+
+        # the modification time tells which details were used least recently
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return details
+
+    def put_pgcr(self, details) -> None:
+        """
+        :param details: The activity details, as Bungie response or SlimPgcr.
+        """
+        if self.slim:
+            details = SlimPgcr.of(details)
+
+        instance_id = SlimPgcr.instance_id_of(details)
+        path = self._path(instance_id)
+
+        if os.path.dirname(path) not in self.shards:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.shards.add(os.path.dirname(path))
+
+        # other runs might be reading the same folder, so they must never see a half-written file
+        temporary_path = path + "." + str(os.getpid()) + ".tmp"
+
+        with open(temporary_path, "wb") as f:
+            f.write(json.dumps(SlimPgcr.serialize(details)).encode("utf8"))
+
+        os.replace(temporary_path, path)
+        self.used.add(instance_id)
+
+    def save(self) -> None:
+        """
+        Details are written as soon as they are added, so this only removes the least recently used details
+        until the folder is below its size limit.
+        """
+        if self.max_bytes is None:
+            return
+
+        files = []
+        total_bytes = 0
+
+        for shard in os.scandir(self.folder):
+            if not shard.is_dir():
+                continue
+
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".json"):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # removed by another run
+                    continue
+
+                files.append((stat.st_mtime, stat.st_size, entry.name[:-len(".json")], entry.path))
+                total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return
+
+        removed = 0
+
+        files.sort()
+
+        for _, size, instance_id, path in files:
+            if total_bytes <= self.max_bytes:
+                break
+
+            if instance_id in self.used:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            total_bytes -= size
+            removed += 1
+
+        if removed > 0:
+            print("Removed " + str(removed) + " least recently used activity details from " + self.folder
+                  + f" to stay below {self.max_bytes / 2 ** 20:.0f} MB")
+
+        if total_bytes > self.max_bytes:
+            print("[WARN] The activity details of this run alone take up " + f"{total_bytes / 2 ** 20:.0f} MB"
+                  + ", which is more than the size limit of " + self.folder)
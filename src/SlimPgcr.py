@@ -0,0 +1,81 @@
+class SlimPgcr:
+    """
+    A compact activity detail record, holding only what comparing against clanmates needs.
+
+    Full Bungie responses carry stats, weapons and teams for every entry, which is most of their size.
+    """
+
+    __slots__ = ("period", "instance_id", "mode", "modes", "membership_ids", "reference_id")
+
+    def __init__(self, period: str, instance_id: str, mode, modes: tuple, membership_ids: tuple,
+                 reference_id=None):
+        self.period = period
+        self.instance_id = instance_id
+        self.mode = mode
+        self.modes = modes
+        self.membership_ids = membership_ids
+        # the hash of the activity definition, see Manifest
+        self.reference_id = reference_id
+
+    @staticmethod
+    def of(details):
+        """
+        Projects activity details down to a SlimPgcr.
+
+        :param details: The activity details, as Bungie response or SlimPgcr.
+        :return: The SlimPgcr. If details already is one, it is returned as is.
+        """
+        if isinstance(details, SlimPgcr):
+            return details
+
+        activity_details = details["activityDetails"]
+
+        return SlimPgcr(
+            period=details["period"],
+            instance_id=str(activity_details["instanceId"]),
+            mode=activity_details.get("mode"),
+            modes=tuple(activity_details.get("modes", [])),
+            membership_ids=tuple(str(entry["player"]["destinyUserInfo"]["membershipId"])
+                                 for entry in details["entries"]),
+            reference_id=activity_details.get("referenceId")
+        )
+
+    @staticmethod
+    def instance_id_of(details) -> str:
+        """
+        :param details: The activity details, as Bungie response or SlimPgcr.
+        :return: The instanceId of the activity, as string.
+        """
+        if isinstance(details, SlimPgcr):
+            return details.instance_id
+
+        return str(details["activityDetails"]["instanceId"])
+
+    @staticmethod
+    def serialize(details):
+        """
+        Converts activity details to something JSON can store.
+
+        :param details: The activity details, as Bungie response or SlimPgcr.
+        :return: The Bungie response as is, or a SlimPgcr as a list.
+        """
+        if isinstance(details, SlimPgcr):
+            return [details.period, details.instance_id, details.mode, list(details.modes),
+                    list(details.membership_ids), details.reference_id]
+
+        return details
+
+    @staticmethod
+    def deserialize(value):
+        """
+        Counterpart of serialize().
+
+        :param value: The value read from JSON.
+        :return: The activity details, as Bungie response or SlimPgcr.
+        """
+        if isinstance(value, list):
+            # records saved before the referenceId was kept have 5 fields
+            [period, instance_id, mode, modes, membership_ids, reference_id] = (value + [None])[:6]
+            return SlimPgcr(period, instance_id, mode, tuple(modes), tuple(membership_ids), reference_id)
+
+        return value
@@ -0,0 +1,353 @@
+import json
+import sqlite3
+from datetime import datetime
+
+from src.ActivityFilterList import ActivityFilterList, activity_modes
+from src.SlimPgcr import SlimPgcr
+
+
+class SqliteStore:
+    """
+    Stores clan members, activity history and activity details (PGCRs) in an SQLite database,
+    as an alternative to the JSON cache files.
+
+    Nothing is loaded into memory as a whole: filtering, sorting and clanmate matching run as indexed queries.
+    Also implements the PGCR cache interface of JsonPgcrCache, and the interface of FetchTimes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS clan_members (
+            clanKey TEXT NOT NULL,
+            memberIndex INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (clanKey, memberIndex)
+        );
+
+        CREATE TABLE IF NOT EXISTS clan_profiles (
+            clanKey TEXT NOT NULL,
+            membershipId TEXT NOT NULL,
+            memberIndex INTEGER NOT NULL,
+            displayName TEXT,
+            PRIMARY KEY (clanKey, membershipId)
+        );
+        CREATE INDEX IF NOT EXISTS clan_profiles_membershipId ON clan_profiles (membershipId);
+
+        CREATE TABLE IF NOT EXISTS activities (
+            player TEXT NOT NULL,
+            instanceId TEXT NOT NULL,
+            characterId TEXT,
+            character INTEGER,
+            period TEXT NOT NULL,
+            mode INTEGER,
+            data TEXT NOT NULL,
+            PRIMARY KEY (player, instanceId)
+        );
+        CREATE INDEX IF NOT EXISTS activities_period ON activities (player, period);
+        CREATE INDEX IF NOT EXISTS activities_character ON activities (player, characterId, period);
+
+        CREATE TABLE IF NOT EXISTS activity_modes (
+            player TEXT NOT NULL,
+            instanceId TEXT NOT NULL,
+            mode INTEGER NOT NULL,
+            PRIMARY KEY (player, instanceId, mode)
+        );
+
+        CREATE TABLE IF NOT EXISTS activity_sync (
+            player TEXT NOT NULL,
+            characterId TEXT NOT NULL,
+            newest TEXT,
+            oldest TEXT,
+            complete INTEGER NOT NULL,
+            skippedAfter TEXT,
+            PRIMARY KEY (player, characterId)
+        );
+
+        CREATE TABLE IF NOT EXISTS pgcrs (
+            instanceId TEXT PRIMARY KEY,
+            period TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS pgcr_entries (
+            instanceId TEXT NOT NULL,
+            entryIndex INTEGER NOT NULL,
+            membershipId TEXT NOT NULL,
+            PRIMARY KEY (instanceId, entryIndex)
+        );
+        CREATE INDEX IF NOT EXISTS pgcr_entries_membershipId ON pgcr_entries (membershipId);
+
+        CREATE TABLE IF NOT EXISTS fetch_times (
+            artifact TEXT PRIMARY KEY,
+            fetched REAL NOT NULL
+        );
+    """
+
+    def __init__(self, filename: str, slim: bool = False):
+        """
+        :param filename: The database file. It is created if it does not exist.
+        :param slim: Whether to store new activity details as SlimPgcr records.
+        """
+        self.filename = filename
+        self.slim = slim
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(self.SCHEMA)
+
+        # databases created before skipped pages were remembered
+        sync_columns = [column for (_, column, *_) in self.connection.execute("PRAGMA table_info(activity_sync)")]
+        if "skippedAfter" not in sync_columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE activity_sync ADD COLUMN skippedAfter TEXT")
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
+
+    # CLAN MEMBERS
+
+    def has_clan_members(self, clan_key: str) -> bool:
+        return self.connection.execute(
+            "SELECT 1 FROM clan_members WHERE clanKey = ? LIMIT 1", (clan_key,)
+        ).fetchone() is not None
+
+    def save_clan_members(self, clan_key: str, members: list) -> None:
+        """
+        Replaces the stored members of a clan.
+
+        :param clan_key: Identifies the clan and the skipped player.
+        :param members: A list of player objects with all memberships.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM clan_members WHERE clanKey = ?", (clan_key,))
+            self.connection.execute("DELETE FROM clan_profiles WHERE clanKey = ?", (clan_key,))
+
+            for member_index, member in enumerate(members):
+                self.connection.execute(
+                    "INSERT INTO clan_members (clanKey, memberIndex, data) VALUES (?, ?, ?)",
+                    (clan_key, member_index, json.dumps(member))
+                )
+
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO clan_profiles (clanKey, membershipId, memberIndex, displayName)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(clan_key, str(profile["membershipId"]), member_index, profile["displayName"])
+                     for profile in member["profiles"]]
+                )
+
+    def load_clan_members(self, clan_key: str) -> list:
+        return [json.loads(data) for (data,) in self.connection.execute(
+            "SELECT data FROM clan_members WHERE clanKey = ? ORDER BY memberIndex", (clan_key,)
+        )]
+
+    # FETCH TIMES
+
+    def get_fetch_time(self, artifact: str) -> float:
+        """
+        :param artifact: The name of the artifact, e.g. "activities_Foo#1234".
+        :return: When it was last requested, as Unix time, or None if that is not known.
+        """
+        row = self.connection.execute("SELECT fetched FROM fetch_times WHERE artifact = ?", (artifact,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_fetch_time(self, artifact: str, fetched: float) -> None:
+        """
+        :param artifact: The name of the artifact, e.g. "activities_Foo#1234".
+        :param fetched: When it was requested, as Unix time.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fetch_times (artifact, fetched) VALUES (?, ?)", (artifact, fetched)
+            )
+
+    # ACTIVITY HISTORY
+
+    def has_activities(self, player: str) -> bool:
+        return self.connection.execute(
+            "SELECT 1 FROM activity_sync WHERE player = ? LIMIT 1", (player,)
+        ).fetchone() is not None
+
+    def save_batches(self, player: str, batches: list, sync: dict, get_modes=None) -> None:
+        """
+        Adds activity batches and replaces the sync state of a player. Known activities are kept as they are.
+
+        :param player: The name the activities are stored under.
+        :param batches: A list of batches, see get_activity_batches().
+        :param sync: The sync state, mapping character IDs to the sync state of the character.
+        :param get_modes: Returns all modes of an activity, which "activity" filters match against.
+                          Defaults to the modes listed in the activity itself.
+        """
+        if get_modes is None:
+            get_modes = activity_modes
+
+        with self.connection:
+            for batch in batches:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO activities (player, instanceId, characterId, character, period, mode, data)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(player, str(activity["activityDetails"]["instanceId"]), batch.get("characterId"),
+                      batch["character"], activity["period"], activity["activityDetails"].get("mode"),
+                      json.dumps(activity))
+                     for activity in batch["data"]]
+                )
+
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO activity_modes (player, instanceId, mode) VALUES (?, ?, ?)",
+                    [(player, str(activity["activityDetails"]["instanceId"]), mode)
+                     for activity in batch["data"]
+                     for mode in get_modes(activity)
+                     if mode is not None]
+                )
+
+            self.connection.execute("DELETE FROM activity_sync WHERE player = ?", (player,))
+            self.connection.executemany(
+                "INSERT INTO activity_sync (player, characterId, newest, oldest, complete, skippedAfter)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(player, character_id, character_sync["newest"], character_sync["oldest"],
+                  int(character_sync["complete"]), character_sync.get("skippedAfter"))
+                 for character_id, character_sync in sync.items()]
+            )
+
+    def load_sync(self, player: str) -> dict:
+        """
+        :param player: The name the activities are stored under.
+        :return: The sync state, mapping character IDs to the sync state of the character.
+        """
+        return {
+            character_id: {
+                "newest": newest, "oldest": oldest, "complete": bool(complete), "skippedAfter": skipped_after
+            }
+            for (character_id, newest, oldest, complete, skipped_after) in self.connection.execute(
+                "SELECT characterId, newest, oldest, complete, skippedAfter FROM activity_sync WHERE player = ?",
+                (player,)
+            )
+        }
+
+    def load_newest_batches(self, player: str) -> list:
+        """
+        Gets the newest stored activities of each character, which is all that an incremental sync needs to know.
+
+        :param player: The name the activities are stored under.
+        :return: A list of batches with the activities at the newest period of each character.
+        """
+        batches = []
+
+        for (character_id, character, newest) in self.connection.execute(
+                "SELECT characterId, character, MAX(period) FROM activities WHERE player = ? GROUP BY characterId",
+                (player,)
+        ).fetchall():
+            data = [json.loads(data) for (data,) in self.connection.execute(
+                "SELECT data FROM activities WHERE player = ? AND characterId = ? AND period = ?",
+                (player, character_id, newest)
+            )]
+
+            batches.append({
+                "character": character,
+                "characterId": character_id,
+                "data": data,
+                "from": newest,
+                "to": newest
+            })
+
+        return batches
+
+    def query_activities(self, player: str, filters: ActivityFilterList) -> list:
+        """
+        Filters and sorts the stored activities of a player.
+
+        :param player: The name the activities are stored under.
+        :param filters: The filters to apply.
+        :return: The activities that passed all filters, oldest-first, with only "period", "timestamp", "characterId",
+                 the instanceId, referenceId and modes in "activityDetails" and the playerCount in "values".
+        """
+        condition, parameters = filters.compileSql("activities")
+
+        return [
+            {
+                "period": period,
+                "timestamp": timestamp if timestamp is not None
+                else int(datetime.fromisoformat(period.replace("Z", "+00:00")).timestamp()),
+                "characterId": character_id,
+                "activityDetails": {"instanceId": instance_id, "referenceId": reference_id, "mode": mode,
+                                    "modes": json.loads(modes or "[]")},
+                "values": {"playerCount": {"basic": {"value": player_count}}} if player_count is not None else {}
+            }
+            for (instance_id, character_id, period, timestamp, reference_id, mode, modes, player_count)
+            in self.connection.execute(
+                "SELECT instanceId, characterId, period, json_extract(data, '$.timestamp'),"
+                " json_extract(data, '$.activityDetails.referenceId'), mode,"
+                " json_extract(data, '$.activityDetails.modes'),"
+                " json_extract(data, '$.values.playerCount.basic.value')"
+                " FROM activities"
+                " WHERE player = ? AND " + condition + " ORDER BY period, instanceId",
+                [player] + parameters
+            )
+        ]
+
+    # ACTIVITY DETAILS
+
+    def has_pgcr(self, instance_id) -> bool:
+        return self.connection.execute(
+            "SELECT 1 FROM pgcrs WHERE instanceId = ?", (str(instance_id),)
+        ).fetchone() is not None
+
+    def get_pgcr(self, instance_id):
+        """
+        :param instance_id: The instanceId of the activity.
+        :return: The activity details, as Bungie response or SlimPgcr, or None if they are not stored.
+        """
+        row = self.connection.execute("SELECT data FROM pgcrs WHERE instanceId = ?", (str(instance_id),)).fetchone()
+        return SlimPgcr.deserialize(json.loads(row[0])) if row is not None else None
+
+    def put_pgcr(self, details) -> None:
+        """
+        :param details: The activity details, as Bungie response or SlimPgcr.
+        """
+        slim = SlimPgcr.of(details)
+
+        if self.slim:
+            details = slim
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pgcrs (instanceId, period, data) VALUES (?, ?, ?)",
+            (slim.instance_id, slim.period, json.dumps(SlimPgcr.serialize(details)))
+        )
+
+        self.connection.execute("DELETE FROM pgcr_entries WHERE instanceId = ?", (slim.instance_id,))
+        self.connection.executemany(
+            "INSERT INTO pgcr_entries (instanceId, entryIndex, membershipId) VALUES (?, ?, ?)",
+            [(slim.instance_id, entry_index, membership_id)
+             for entry_index, membership_id in enumerate(slim.membership_ids)]
+        )
+
+        # commit right away, so an interrupted run loses nothing
+        self.connection.commit()
+
+    def save(self) -> None:
+        self.connection.commit()
+
+    # MATCHING
+
+    def query_clanmate_matches(self, player: str, clan_key: str, filters: ActivityFilterList, limit: int = 0):
+        """
+        Finds all filtered activities of a player that had clanmates in them.
+
+        :param player: The name the activities are stored under.
+        :param clan_key: Identifies the clan and the skipped player.
+        :param filters: The filters to apply.
+        :param limit: Only return the first n matches, 0 to return all.
+        :return: An iterator of tuples (period, instanceId, referenceId, displayName), oldest-first.
+        """
+        condition, parameters = filters.compileSql("activities")
+
+        query = "SELECT activities.period, activities.instanceId," \
+                " json_extract(activities.data, '$.activityDetails.referenceId'), clan_profiles.displayName" \
+                " FROM activities" \
+                " JOIN pgcr_entries ON pgcr_entries.instanceId = activities.instanceId" \
+                " JOIN clan_profiles ON clan_profiles.membershipId = pgcr_entries.membershipId" \
+                " AND clan_profiles.clanKey = ?" \
+                " WHERE activities.player = ? AND " + condition + \
+                " ORDER BY activities.period, activities.instanceId, pgcr_entries.entryIndex"
+
+        if limit != 0:
+            query += " LIMIT " + str(int(limit))
+
+        return self.connection.execute(query, [clan_key, player] + parameters)
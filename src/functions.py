@@ -1,62 +1,454 @@
 import asyncio
+import itertools
 import json
+import mmap
 import os
+import random
+import shutil
+import sqlite3
 import sys
 import time
+import zipfile
 from datetime import datetime
-from io import BytesIO
 
 import aiobungie
 import aiocurl
 import requests
 
+from src.ActivityFilterList import activity_modes
+from src.CacheCompression import CacheCompression
+from src.CurlPool import CurlPool
+from src.FetchTimes import FetchTimes
+from src.FirstMeetings import FirstMeetings
+from src.JsonArrayReader import JsonArrayReader
+from src.JsonPgcrCache import JsonPgcrCache
+from src.Manifest import Manifest
+from src.Metrics import Metrics
+from src.RateLimiter import RateLimiter
 from src.Settings import Settings
+from src.SharedPgcrStore import SharedPgcrStore
+from src.SlimPgcr import SlimPgcr
+from src.SqliteStore import SqliteStore
+
 
 headers = {}
 
+# backoff of retries of failed requests, see get_retry_delay()
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
 
-def get(endpoint: str):
+# keeps connections alive between the blocking requests
+session = requests.Session()
+
+rate_limiter = RateLimiter()
+
+metrics = Metrics(rate_limiter)
+
+store = None
+
+manifest = None
+
+fetch_times = None
+
+
+def get_store() -> SqliteStore:
     """
-    Does a GET request to the Bungie API.
+    Opens the SQLite store in the data folder, if not opened yet.
+
+    :return: The store, or None if Settings.UseSqliteStore is off.
+    """
+    global store
+
+    if not Settings.UseSqliteStore:
+        return None
+
+    if store is None:
+        store = SqliteStore(os.path.join(Settings.DataFolder, "store.sqlite"), Settings.SlimActivityDetails)
+        print('Using data store ' + store.filename)
+
+    return store
+
+
+def close_store() -> None:
+    global store
+
+    if store is not None:
+        store.close()
+        store = None
+
+
+def get_fetch_times():
+    """
+    :return: Where to keep when each cached artifact was requested: the SQLite store if enabled,
+             a file in the data folder otherwise. See FetchTimes for the interface.
+    """
+    global fetch_times
+
+    data_store = get_store()
+
+    if data_store is not None:
+        return data_store
+
+    if fetch_times is None:
+        fetch_times = FetchTimes(os.path.join(Settings.DataFolder, "fetch_times.json"))
+
+    return fetch_times
+
+
+def needs_requery(requery: bool, artifact: str, max_age_hours: float, cached: bool) -> bool:
+    """
+    Decides whether to request an artifact from Bungie again, or to read it from cache.
+
+    :param requery: The Requery* setting of the artifact: True to always request it,
+                    False to never request it, None to request it when it is not cached or too old.
+    :param artifact: The name of the artifact, see get_fetch_times().
+    :param max_age_hours: How old the artifact may get, None for no limit.
+    :param cached: Whether the artifact is cached.
+    :return: Whether to request the artifact.
+    """
+    if requery is not None:
+        return requery
+
+    if not cached:
+        return True
+
+    if max_age_hours is None:
+        return False
+
+    fetched = get_fetch_times().get_fetch_time(artifact)
+
+    # cached before fetch times were kept
+    if fetched is None:
+        print("Cached " + artifact + " is of unknown age, requesting it again")
+        return True
+
+    age_hours = (time.time() - fetched) / 3600
+
+    if age_hours > max_age_hours:
+        print("Cached " + artifact + f" is {age_hours:.1f} hours old, requesting it again")
+        return True
+
+    print("Cached " + artifact + f" is {age_hours:.1f} hours old, still fresh")
+    return False
+
+
+def get_manifest() -> Manifest:
+    """
+    Loads the Destiny manifest, if not loaded yet.
+    Uses Settings.ManifestFile if set, otherwise the current manifest is downloaded to the data folder once.
+
+    :return: The manifest, or None if Settings.UseManifest is off.
+    """
+    global manifest
+
+    if not Settings.UseManifest:
+        return None
+
+    if manifest is None:
+        filename = Settings.ManifestFile or download_manifest()
+
+        try:
+            manifest = Manifest(filename)
+        except sqlite3.Error as e:
+            sys.stdout.flush()
+            sys.stderr.write('Error: Cannot read Destiny manifest ' + filename + ': ' + str(e) + "\n")
+            exit(1)
+
+        print('Read ' + str(len(manifest.activities)) + ' activity definitions from ' + filename)
+
+    return manifest
+
+
+def download_manifest() -> str:
+    """
+    Downloads the current Destiny manifest to the data folder, unless it is there already.
+    Older versions are removed.
+
+    :return: The filename of the manifest content database.
+    """
+    paths = get("/Destiny2/Manifest/")["mobileWorldContentPaths"]
+
+    if Settings.ManifestLanguage not in paths:
+        sys.stdout.flush()
+        sys.stderr.write('Error: There is no Destiny manifest in language "' + Settings.ManifestLanguage + '".'
+                         + " Available are: " + ", ".join(sorted(paths)) + "\n")
+        exit(1)
+
+    path = paths[Settings.ManifestLanguage]
+    folder = os.path.join(Settings.DataFolder, "manifest")
+    filename = os.path.join(folder, os.path.basename(path))
+
+    if os.path.exists(filename):
+        return filename
+
+    os.makedirs(folder, exist_ok=True)
+    print("Downloading Destiny manifest from " + Settings.Advanced_ContentRoot + path)
+
+    response = session.get(Settings.Advanced_ContentRoot + path, headers=headers, stream=True,
+                           timeout=(Settings.Advanced_ConnectTimeout, Settings.Advanced_RequestTimeout))
+
+    if response.status_code != 200:
+        raise BrokenPipeError("Download of the Destiny manifest yielded status code " + str(response.status_code))
+
+    # the content database comes as the only file in a zip archive
+    archive_filename = filename + ".zip"
+
+    with open(archive_filename, "wb") as f:
+        for chunk in response.iter_content(chunk_size=2 ** 20):
+            f.write(chunk)
+
+    with zipfile.ZipFile(archive_filename) as archive, \
+            archive.open(archive.namelist()[0]) as source, \
+            open(filename + ".tmp", "wb") as target:
+        shutil.copyfileobj(source, target)
+
+    os.replace(filename + ".tmp", filename)
+    os.remove(archive_filename)
+
+    # older versions of the manifest
+    for other in os.listdir(folder):
+        if other != os.path.basename(filename):
+            os.remove(os.path.join(folder, other))
+
+    print("Saved Destiny manifest to " + filename)
+
+    return filename
+
+
+def get_activity_modes(activity: dict) -> set:
+    """
+    :param activity: An activity from the activity history.
+    :return: All modes the activity counts towards,
+             including those its definition in the manifest lists, if Settings.UseManifest is on.
+    """
+    return activity_modes(activity, manifest)
+
+
+def get_class_name(class_type) -> str:
+    """
+    :param class_type: The class of a character.
+    :return: The name of the class, from the manifest if Settings.UseManifest is on.
+    """
+    if manifest is not None and manifest.get_class_name(class_type) is not None:
+        return manifest.get_class_name(class_type)
+
+    return aiobungie.Class(class_type).__str__()
 
+
+def describe_activity(activity_id, activity_hash) -> str:
+    """
+    :param activity_id: The instanceId of an activity.
+    :param activity_hash: The referenceId of the activity, None if unknown.
+    :return: The text to show for the activity in results, with its name if Settings.UseManifest is on.
+    """
+    text = "Activity " + str(activity_id)
+
+    if manifest is not None and activity_hash is not None:
+        label = manifest.get_activity_label(int(activity_hash))
+
+        if label is not None:
+            text += " (" + label + ")"
+
+    return text
+
+
+def get_clan_key(clan_id, skip) -> str:
+    if skip is None:
+        return str(clan_id)
+
+    return f"{clan_id}_without_{skip}"
+
+
+def _decode_response(response: requests.Response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def get_retry_delay(attempt: int) -> float:
+    """
+    Gets the time to wait before retrying a failed request: exponential backoff with full jitter,
+    so requests that failed together do not retry together.
+
+    :param attempt: The number of the retry, starting at 1.
+    :return: The amount of seconds to wait.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def request(method: str, endpoint: str, body=None):
+    """
+    Does a blocking request to the Bungie API, retrying failed requests up to Settings.Advanced_MaxRetries times,
+    and throttled ones up to Settings.Advanced_MaxThrottleRetries times.
+
+    :param method: "GET" or "POST".
     :param endpoint: The endpoint, not the full URL.
+    :param body: The data to include in the request.
     :return: The Bungie Response content.
     """
-    _data = requests.get(
-        "https://www.bungie.net/platform" + endpoint,
-        headers=headers
-    )
+    attempt = 0
+    throttled = 0
+
+    while True:
+        rate_limiter.wait()
+
+        token = metrics.request_started(endpoint)
+
+        try:
+            _data = session.request(
+                method,
+                Settings.Advanced_ApiRoot + endpoint,
+                headers=headers,
+                data=body,
+                timeout=(Settings.Advanced_ConnectTimeout, Settings.Advanced_RequestTimeout)
+            )
+        except requests.RequestException as e:
+            metrics.request_failed(token)
+            # the connection might be overloaded, unlike with a server error
+            rate_limiter.decrease()
+            error = str(e)
+        else:
+            decoded = _decode_response(_data)
+            metrics.request_finished(token, _data.status_code, decoded, len(_data.content))
+
+            if rate_limiter.report(_data.status_code, decoded):
+                throttled += 1
+
+                if throttled > Settings.Advanced_MaxThrottleRetries:
+                    raise BrokenPipeError(method + " request to " + endpoint + " was throttled " + str(throttled)
+                                          + " times")
+
+                metrics.retried("throttle")
+                continue
+
+            if _data.status_code < 500:
+                break
+
+            error = "status code " + str(_data.status_code)
+
+        attempt += 1
+
+        if attempt > Settings.Advanced_MaxRetries:
+            raise BrokenPipeError(method + " request to " + endpoint + " failed " + str(attempt) + " times: " + error)
+
+        delay = get_retry_delay(attempt)
+        print("[WARN] " + method + " request to " + endpoint + " failed (" + error + ")"
+              + f" - retrying in {delay:.1f} seconds")
+        metrics.retried("error")
+        time.sleep(delay)
 
     if _data.status_code == 200:
         return _data.json()["Response"]
 
     raise BrokenPipeError(
-        "GET request to " + endpoint + " yielded status code " + str(_data.status_code) + ": "
+        method + " request to " + endpoint + " yielded status code " + str(_data.status_code) + ": "
         + _data.text
     )
 
 
-def post(endpoint: str, _data):
+def get(endpoint: str):
     """
     Does a GET request to the Bungie API.
 
+    :param endpoint: The endpoint, not the full URL.
+    :return: The Bungie Response content.
+    """
+    return request("GET", endpoint)
+
+
+def post(endpoint: str, _data):
+    """
+    Does a POST request to the Bungie API.
+
     :param endpoint: The endpoint, not the full URL.
     :param _data: The data to include in the request.
     :return: The Bungie Response content.
     """
-    _data = requests.post(
-        "https://www.bungie.net/platform" + endpoint,
-        headers=headers,
-        data=_data
-    )
+    return request("POST", endpoint, _data)
 
-    if _data.status_code == 200:
-        return _data.json()["Response"]
 
-    raise BrokenPipeError(
-        "POST request to " + endpoint + " yielded status code " + str(_data.status_code) + ": "
-        + _data.text
-    )
+async def request_clan_roster(pool: CurlPool, clan_id) -> list:
+    """
+    Requests all pages of the clan roster.
+
+    :param pool: The curl pool to do the requests with.
+    :param clan_id: GroupId of the clan to use.
+    :return: The list of clan members, as returned by Bungie.
+    """
+    clan_members = []
+    page = 1
+
+    while True:
+        data = await request_bungie(
+            pool,
+            Settings.Advanced_ApiRoot + f"/GroupV2/{clan_id}/Members/?currentpage={page}"
+        )
+        clan_members.extend(data["results"])
+
+        if not data.get("hasMore", False):
+            return clan_members
+
+        page += 1
+
+
+async def queue_clan_roster(clan_id) -> list:
+    pool = create_curl_pool()
+
+    try:
+        return await request_clan_roster(pool, clan_id)
+    finally:
+        pool.close()
+
+
+async def queue_clan_members(clan_id, skip) -> list:
+    """
+    Requests all pages of the clan roster, then the linked profiles of all members concurrently.
+
+    :param clan_id: GroupId of the clan to use.
+    :param skip: Primary membershipId of the player to skip, None to skip nobody.
+    :return: A list of all player objects with all memberships.
+    """
+    pool = create_curl_pool()
+
+    try:
+        clan_members = await request_clan_roster(pool, clan_id)
+
+        members = []
+
+        for member in clan_members:
+            if str(member["destinyUserInfo"]["membershipId"]) == skip:
+                print("Skipping " + str(skip) + "...")
+                continue
+
+            members.append(member)
+
+        length = len(members)
+        state = {
+            "finished": 0
+        }
+
+        print("Requesting data of " + str(length) + " clan members")
+
+        async def request_profile(member):
+            profile = await request_bungie(
+                pool,
+                Settings.Advanced_ApiRoot + "/Destiny2/{membershipType}/Profile/{membershipId}/LinkedProfiles/?getAllMemberships=true"
+                .format(membershipType=member["destinyUserInfo"]["membershipType"],
+                        membershipId=member["destinyUserInfo"]["membershipId"])
+            )
+
+            state["finished"] += 1
+            finished = state["finished"]
+
+            if finished % Settings.Advanced_AsyncThreadAmount == 0 or finished == length:
+                print("Requested data of " + str(finished) + " / " + str(length) + " clan members")
+
+            return profile
+
+        return await asyncio.gather(*[request_profile(member) for member in members])
+    finally:
+        pool.close()
 
 
 def get_clan_members_with_all_memberships(clan_id, skip):
@@ -64,118 +456,581 @@ def get_clan_members_with_all_memberships(clan_id, skip):
     Get a list of clan members, skipping over the given ID.
 
     :param clan_id: GroupId of the clan to use.
-    :param skip: Primary membershipId of the player to skip.
+    :param skip: Primary membershipId of the player to skip, None to skip nobody.
     :return: A list of all player objects with all memberships.
     """
 
-    filename = os.path.join(Settings.DataFolder, f"clanmembers_{clan_id}_without_{skip}.json")
+    filename = os.path.join(Settings.DataFolder, f"clanmembers_{get_clan_key(clan_id, skip)}.json")
+    data_store = get_store()
+
+    if data_store is not None:
+        filename = data_store.filename
+        cached = data_store.has_clan_members(get_clan_key(clan_id, skip))
+    else:
+        cached = os.path.exists(filename)
 
-    if not os.path.exists(filename) and not Settings.RequeryClanmates:
+    if not cached and Settings.RequeryClanmates is False:
         sys.stdout.flush()
         sys.stderr.write('Error: Cannot read clan members from cache: File not found: ' + filename + "\n")
         exit(1)
 
-    requery = Settings.RequeryClanmates
+    artifact = f"clanmembers_{get_clan_key(clan_id, skip)}"
+    requery = needs_requery(Settings.RequeryClanmates, artifact, Settings.ClanmatesMaxAgeHours, cached)
+
+    if requery:
+        fetched = time.time()
+        clan_details = get(f"/GroupV2/{clan_id}/")
+        print("Loading clan member details for " + clan_details["detail"]["name"])
+
+        _data = asyncio.run(queue_clan_members(clan_id, skip))
+
+        if data_store is not None:
+            data_store.save_clan_members(get_clan_key(clan_id, skip), _data)
+        else:
+            with open(filename, "w") as f:
+                json.dump(_data, f)
+        print('Saved clan member details to ' + filename)
+
+        get_fetch_times().set_fetch_time(artifact, fetched)
+
+    print('Read clan member details from ' + filename)
+
+    if data_store is not None:
+        return data_store.load_clan_members(get_clan_key(clan_id, skip))
+
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def get_activity_date(activity_id) -> str:
+    """
+    Gets the date of an activity in ISO format
+
+    :param activity_id: The activity ID, as number or string.
+    :return: The date, in ISO format
+    """
+    data = get("/Destiny2/Stats/PostGameCarnageReport/{}/".format(activity_id))
+    return data["period"]
+
+
+def iso_to_nice_iso(date_str: str) -> str:
+    """
+    datetime.fromisoformat() doesn"t like the "Z" timezone, so we convert it to "+00:00"
+
+    :param date_str: The date ending in Z
+    :return: The same date, ending in +00:00
+    """
+    return date_str[:len(date_str) - 1] + "+00:00"
+
+
+def get_activity_timestamp(activity: dict) -> int:
+    """
+    Gets the date of an activity as Unix timestamp. It is parsed only once and then kept on the activity,
+    as "timestamp" next to "period".
+
+    :param activity: An activity from the activity history.
+    :return: The "period" of the activity, in seconds since the epoch.
+    """
+    timestamp = activity.get("timestamp")
+
+    if timestamp is None:
+        timestamp = int(datetime.fromisoformat(iso_to_nice_iso(activity["period"])).timestamp())
+        activity["timestamp"] = timestamp
+
+    return timestamp
+
+
+def get_player(player_bungiename: str = None):
+    """
+    Looks up a player by Bungie Name.
+
+    :param player_bungiename: The Bungie Name, including the #code. Settings.BungieName if not given.
+    :return: A tuple (membershipId, membershipType, display name).
+    """
+    if player_bungiename is None:
+        player_bungiename = Settings.BungieName
+
+    [display_name, display_name_code] = player_bungiename.split("#", 2)
+
+    player_object = {
+        "displayName": display_name,
+        "displayNameCode": display_name_code
+    }
+
+    profiles = post("/Destiny2/SearchDestinyPlayerByBungieName/-1/", json.dumps(player_object))
+
+    membership_id = profiles[0]["membershipId"]
+    membership_type = profiles[0]["membershipType"]
+
+    return membership_id, membership_type, display_name
+
+
+async def find_first_page(request_page, before: str, max_pages: int) -> int:
+    """
+    Finds the first activity page that contains activities from before the given date.
+    Pages are newest-first, so this gallops ahead and then bisects instead of requesting every newer page.
+
+    :param request_page: A function returning an awaitable of the Bungie response for a page index.
+    :param before: The date in the format of Bungie's "period" values.
+    :param max_pages: The amount of pages to search.
+    :return: The index of the first page that is not entirely newer than the given date.
+    """
+
+    async def reaches_before(page) -> bool:
+        data = await request_page(page)
+        return "activities" not in data or data["activities"][-1]["period"] <= before
+
+    low = 0
+    high = 0
+
+    while not await reaches_before(high):
+        low = high + 1
+
+        if high == max_pages - 1:
+            return max_pages
+
+        high = min(high * 2 + 1, max_pages - 1)
+
+    while low < high:
+        middle = (low + high) // 2
+
+        if await reaches_before(middle):
+            high = middle
+        else:
+            low = middle + 1
+
+    return low
+
+
+def activity_page_url(membership_type, membership_id, character_id, page) -> str:
+    return Settings.Advanced_ApiRoot + "/Destiny2/{membershipType}/Account/{destinyMembershipId}/Character/{characterId}/Stats/Activities/?mode=0&count=250&page={page}".format(
+        membershipType=membership_type,
+        destinyMembershipId=membership_id,
+        characterId=character_id,
+        page=page
+    )
+
+
+def create_batch(character_id, character_type, activities: list) -> dict:
+    """
+    Creates a batch from a list of activities.
+
+    :param character_id: The character ID.
+    :param character_type: The class of the character.
+    :param activities: The activities, newest-first.
+    :return: The batch, see get_activity_batches().
+    """
+
+    # stored with the activities, so later runs do not need to parse dates again
+    for activity in activities:
+        get_activity_timestamp(activity)
+
+    return {
+        "character": character_type,
+        "characterId": str(character_id),
+        "data": activities,
+        "from": iso_to_nice_iso(activities[-1]["period"]),
+        "to": iso_to_nice_iso(activities[0]["period"])
+    }
+
+
+async def request_character_activities(pool: CurlPool, membership_type, membership_id, character_id, character_type,
+                                       after: str = None, before: str = None) -> tuple:
+    """
+    Requests all activity pages of a character, prefetching Settings.Advanced_HistoryPrefetchPages pages ahead.
+
+    :param pool: The curl pool to do the requests with.
+    :param membership_type: The membership_type of the player.
+    :param membership_id: The membership_id of the player.
+    :param character_id: The character ID.
+    :param character_type: The class of the character.
+    :param after: Stop after the first page reaching past this date, in the format of Bungie's "period" values.
+    :param before: Skip pages that are entirely newer than this date, in the format of Bungie's "period" values.
+    :return: A tuple (batches, complete, skipped). batches is a list of batches, see get_activity_batches().
+             complete is whether the batches reach back to the very first activity of the character.
+             skipped is whether pages newer than before were skipped.
+    """
+    character_name = get_class_name(character_type)
+
+    print("Requesting activities for character with ID " + str(character_id) + " (" + character_name + ")")
+
+    pages = {}
+
+    def request_page(page):
+        if page not in pages:
+            pages[page] = asyncio.ensure_future(request_bungie(
+                pool,
+                activity_page_url(membership_type, membership_id, character_id, page)
+            ))
+
+        return pages[page]
+
+    _activities = []
+    complete = False
+    first_page = 0
+
+    try:
+
+        if before is not None:
+            first_page = await find_first_page(request_page, before, 500)
+            if first_page > 0:
+                print("Skipped " + str(first_page) + " pages of " + character_name + " activities after " + before)
+
+        for i in range(first_page, 500):
+            for page in range(i + 1, min(i + 1 + Settings.Advanced_HistoryPrefetchPages, 500)):
+                request_page(page)
+
+            data = await request_page(i)
+
+            if "activities" not in data:
+                print("Loaded data for " + character_name + ", " + str(len(_activities)) + " batches total")
+                complete = True
+                break
+
+            _activities.append(create_batch(character_id, character_type, data["activities"]))
+
+            print("Requested " + character_name + " activity page " + str(i)
+                  + ", ranging from " + data["activities"][-1]["period"]
+                  + " to " + data["activities"][0]["period"])
+
+            if after is not None and data["activities"][-1]["period"] < after:
+                print("Loaded data for " + character_name + " up to " + after + ", "
+                      + str(len(_activities)) + " batches total")
+                break
+    finally:
+        # drop speculative requests for pages past the end
+        for task in pages.values():
+            task.cancel()
+
+        await asyncio.gather(*pages.values(), return_exceptions=True)
+
+    return _activities, complete, first_page > 0
+
+
+async def request_new_character_activities(pool: CurlPool, membership_type, membership_id, character_id,
+                                           character_type, newest: str, known_ids: set) -> list:
+    """
+    Requests the activities of a character that are newer than the already known ones.
+
+    :param pool: The curl pool to do the requests with.
+    :param membership_type: The membership_type of the player.
+    :param membership_id: The membership_id of the player.
+    :param character_id: The character ID.
+    :param character_type: The class of the character.
+    :param newest: The period of the newest known activity.
+    :param known_ids: The instanceIds of the known activities around that period.
+    :return: The new activities, newest-first.
+    """
+    character_name = get_class_name(character_type)
+
+    new_activities = []
+
+    for i in range(500):
+        data = await request_bungie(pool, activity_page_url(membership_type, membership_id, character_id, i))
+
+        if "activities" not in data:
+            break
+
+        for activity in data["activities"]:
+            if activity["period"] < newest or activity["activityDetails"]["instanceId"] in known_ids:
+                print("Found " + str(len(new_activities)) + " new " + character_name + " activities since " + newest)
+                return new_activities
+
+            new_activities.append(activity)
+
+    print("Found " + str(len(new_activities)) + " new " + character_name + " activities, reached the end of history")
+    return new_activities
+
+
+async def sync_character_activities(pool: CurlPool, membership_type, membership_id, character_id, character_type,
+                                    after: str, before: str, previous: list, sync: dict) -> tuple:
+    """
+    Brings the stored batches of a character up to date.
+
+    If the stored batches reach back far enough, only activities newer than the stored ones are requested
+    as a new batch, to put in front of the stored ones. Otherwise, the history is requested from scratch.
+
+    :param pool: The curl pool to do the requests with.
+    :param membership_type: The membership_type of the player.
+    :param membership_id: The membership_id of the player.
+    :param character_id: The character ID.
+    :param character_type: The class of the character.
+    :param after: See request_character_activities().
+    :param before: See request_character_activities().
+    :param previous: The newest stored batch of this character, as a list, empty if there is none.
+    :param sync: The stored sync state of this character, or None. See sync_covers_date_window().
+    :return: A tuple (batches, sync, keep_stored), with the new batches of this character, newest-first,
+             the new sync state and whether the stored batches are kept behind the new ones.
+    """
+    if not sync_reaches_back(sync, after):
+        batches, complete, skipped = await request_character_activities(pool, membership_type, membership_id,
+                                                                        character_id, character_type, after, before)
+
+        return batches, {
+            "newest": batches[0]["data"][0]["period"] if len(batches) > 0 else None,
+            "oldest": batches[-1]["data"][-1]["period"] if len(batches) > 0 else None,
+            "complete": complete,
+            "skippedAfter": before if skipped else None
+        }, False
+
+    # a character without any activities has no newest activity, so everything is new
+    newest = sync["newest"] if sync["newest"] is not None else ""
+
+    if before is not None and before < newest:
+        # anything newer is outside the date filters anyway
+        return [], sync, True
+
+    known_ids = set()
+    if len(previous) > 0:
+        known_ids = {activity["activityDetails"]["instanceId"] for activity in previous[0]["data"]}
+
+    new_activities = await request_new_character_activities(pool, membership_type, membership_id, character_id,
+                                                            character_type, newest, known_ids)
+
+    # the new activities reach up to now, so nothing newer is skipped anymore
+    if len(new_activities) == 0:
+        return [], {**sync, "skippedAfter": None}, True
+
+    return [create_batch(character_id, character_type, new_activities)], {
+        "newest": new_activities[0]["period"],
+        "oldest": sync["oldest"] if sync["oldest"] is not None else new_activities[-1]["period"],
+        "complete": sync["complete"],
+        "skippedAfter": None
+    }, True
+
+
+def sync_reaches_back(sync: dict, after: str) -> bool:
+    """
+    :param sync: The stored sync state of a character, or None.
+    :param after: See request_character_activities().
+    :return: Whether the stored batches of the character reach back far enough for the "date" filters,
+             so they only need to be updated with newer activities.
+    """
+    return sync is not None \
+        and (sync["complete"] or (after is not None and sync["oldest"] is not None and sync["oldest"] <= after))
+
+
+def sync_covers_date_window(sync: dict, after: str, before: str) -> bool:
+    """
+    :param sync: The stored sync state, mapping character IDs to the sync state of the character, or None.
+    :param after: See request_character_activities().
+    :param before: See request_character_activities().
+    :return: Whether the stored batches hold all activities within the "date" filters, as of when they were requested.
+    """
+    if sync is None:
+        return False
+
+    for character_sync in sync.values():
+        if not sync_reaches_back(character_sync, after):
+            return False
+
+        # newer pages were skipped when these were requested, which might be needed now
+        skipped_after = character_sync.get("skippedAfter")
+        if skipped_after is not None and (before is None or before > skipped_after):
+            return False
+
+    return True
+
+
+async def queue_character_activities(membership_type, membership_id, characters: dict,
+                                     after: str = None, before: str = None,
+                                     previous: list = None, sync: dict = None) -> tuple:
+    """
+    Requests the activity pages of all characters concurrently.
+
+    :param membership_type: The membership_type of the player.
+    :param membership_id: The membership_id of the player.
+    :param characters: The "characters" data of the Bungie profile response, mapping character IDs to characters.
+    :param after: See request_character_activities().
+    :param before: See request_character_activities().
+    :param previous: The newest stored batch of each character.
+    :param sync: The stored sync state, mapping character IDs to the sync state of the character.
+    :return: A tuple (batches, sync, kept) of the new batches of all characters, the new sync state
+             and the set of character IDs whose stored batches are kept.
+    """
+    previous = previous if previous is not None else []
+    sync = sync if sync is not None else {}
+
+    pool = create_curl_pool()
+
+    try:
+        results = await asyncio.gather(*[
+            sync_character_activities(pool, membership_type, membership_id, character_id,
+                                      characters[character_id]["classType"], after, before,
+                                      [batch for batch in previous if batch.get("characterId") == str(character_id)],
+                                      sync.get(str(character_id)))
+            for character_id in characters
+        ])
+    finally:
+        pool.close()
+
+    _activities = []
+    new_sync = {}
+    kept = set()
+
+    for character_id, [batches, character_sync, keep_stored] in zip(characters, results):
+        _activities.extend(batches)
+        new_sync[str(character_id)] = character_sync
+
+        if keep_stored:
+            kept.add(str(character_id))
 
-    if requery:
-        clan_details = get(f"/GroupV2/{clan_id}/")
-        print("Loading clan member details for " + clan_details["detail"]["name"])
+    return _activities, new_sync, kept
 
-        clan_members = get(f"/GroupV2/{clan_id}/Members/")
 
-        _data = []
+def get_cache_filename(filename: str) -> str:
+    """
+    :param filename: A cache file that is read front to back, as JSON.
+    :return: The file to save it to, compressed as a whole if Settings.CompressCaches is set.
+    """
+    return filename + CacheCompression.stream_extension(Settings.CompressCaches)
 
-        for member in clan_members["results"]:
-            member_id = member["destinyUserInfo"]["membershipId"]
-            member_type = member["destinyUserInfo"]["membershipType"]
 
-            if str(member_id) == skip:
-                print("Skipping " + str(member_id) + "...")
-                continue
+def find_cache_file(filename: str) -> str:
+    """
+    :param filename: A cache file that is read front to back, as JSON.
+    :return: The file or one of its compressed variants, whichever exists,
+             preferring the one of Settings.CompressCaches. None if none exists.
+    """
+    for variant in get_cache_file_variants(filename):
+        if os.path.exists(variant):
+            return variant
 
-            print("Requesting data of clanmember ID " + str(member_id))
+    return None
 
-            profile = get(
-                "/Destiny2/{membershipType}/Profile/{membershipId}/LinkedProfiles/?getAllMemberships=true"
-                    .format(membershipType=member_type, membershipId=member_id)
-            )
 
-            _data.append(profile)
+def get_cache_file_variants(filename: str) -> list:
+    """
+    :param filename: A cache file that is read front to back, as JSON.
+    :return: The file and all its compressed variants, starting with the one of Settings.CompressCaches.
+    """
+    variants = [get_cache_filename(filename), filename]
 
-        with open(filename, "w") as f:
-            json.dump(_data, f)
-            print('Saved clan member details to ' + filename)
+    for extension in CacheCompression.STREAM_EXTENSIONS.values():
+        if filename + extension not in variants:
+            variants.append(filename + extension)
 
-    with open(filename, "r") as f:
-        print('Read clan member details from ' + filename)
-        return json.load(f)
+    return variants
 
 
-def get_activity_date(activity_id) -> str:
+def read_json_array(filename: str):
     """
-    Gets the date of an activity in ISO format
+    Reads a JSON array from a file one element at a time, memory-mapped if Settings.Advanced_MemoryMapCaches is on.
+    Compressed files (see get_cache_filename()) are decompressed on the fly instead.
 
-    :param activity_id: The activity ID, as number or string.
-    :return: The date, in ISO format
+    :param filename: The file to read.
+    :return: An iterator of the elements.
     """
-    data = get("/Destiny2/Stats/PostGameCarnageReport/{}/".format(activity_id))
-    return data["period"]
+    codec = CacheCompression.stream_codec_of(filename)
 
+    if codec is not None:
+        with CacheCompression.open_stream(filename, "rb", codec) as f:
+            yield from JsonArrayReader(f)
+            return
 
-def iso_to_nice_iso(date_str: str) -> str:
-    """
-    datetime.fromisoformat() doesn"t like the "Z" timezone, so we convert it to "+00:00"
+    with open(filename, "rb") as f:
+        if not Settings.Advanced_MemoryMapCaches or os.path.getsize(filename) == 0:
+            yield from JsonArrayReader(f)
+            return
 
-    :param date_str: The date ending in Z
-    :return: The same date, ending in +00:00
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            yield from JsonArrayReader(source)
+
+
+def write_json_array(filename: str, values) -> None:
     """
-    return date_str[:len(date_str) - 1] + "+00:00"
+    Writes values to a file as a JSON array, one at a time, replacing the file once everything is written.
+    Compressed by the extension of the file, see get_cache_filename().
 
+    :param filename: The file to write.
+    :param values: The values, or an iterator of them. May read from the file that is replaced.
+    """
+    temporary_filename = filename + ".tmp"
+    codec = CacheCompression.stream_codec_of(filename)
 
-def get_player():
-    player_bungiename = Settings.BungieName
+    if codec is not None:
+        f = CacheCompression.open_stream(temporary_filename, "wb", codec)
+    else:
+        f = open(temporary_filename, "wb")
 
-    [display_name, display_name_code] = player_bungiename.split("#", 2)
+    with f:
+        f.write(b"[")
 
-    player_object = {
-        "displayName": display_name,
-        "displayNameCode": display_name_code
-    }
+        for index, value in enumerate(values):
+            if index > 0:
+                f.write(b", ")
 
-    profiles = post("/Destiny2/SearchDestinyPlayerByBungieName/-1/", json.dumps(player_object))
+            f.write(json.dumps(value).encode("utf8"))
 
-    membership_id = profiles[0]["membershipId"]
-    membership_type = profiles[0]["membershipType"]
+        f.write(b"]")
 
-    return membership_id, membership_type, display_name
+    os.replace(temporary_filename, filename)
 
 
-def get_activity_batches(player_id, player_membership, file_identifier: str) -> list:
+def get_activity_batches(player_id, player_membership, file_identifier: str):
     """
     Gets activities in sizes of 250 (the Bungie limit)
 
+    Pages outside the range of the configured "date" filters are not stored, and are not requested
+    where that can be avoided. The newest stored activity of each character is remembered,
+    so later runs only request what is new since then.
+
     :param file_identifier: The name to add to the filename
     :param player_id: The membership_id of the player.
     :param player_membership: The membership_type of the player.
-    :return: A list of the batches in the format
+    :return: An iterator of the batches, read from the file one at a time, newest-first for each character,
+    in the format
     {
-        "character": int, # character type
-        "data": list,     # Bungie response
-        "from": string,   # first date of the batch
-        "to": string      # last date of the batch
+        "character": int,   # character type
+        "characterId": str, # character ID
+        "data": list,       # Bungie response, with a "timestamp" added to each activity
+        "from": string,     # first date of the batch
+        "to": string        # last date of the batch
     }
+    When using the SQLite store, nothing is returned. Use SqliteStore.query_activities() instead.
     """
 
     filename = os.path.join(Settings.DataFolder, f"activities_{file_identifier}.json")
+    sync_filename = os.path.join(Settings.DataFolder, f"activities_{file_identifier}_sync.json")
+    data_store = get_store()
+
+    # the file might still be compressed differently than set, then it is converted once it is saved again
+    plain_filename = filename
+    stored_filename = find_cache_file(plain_filename)
+    filename = get_cache_filename(plain_filename)
+
+    if data_store is not None:
+        filename = data_store.filename
+        cached = data_store.has_activities(file_identifier)
+    else:
+        cached = stored_filename is not None
 
-    if not os.path.exists(filename) and not Settings.RequeryActivityBatches:
+    if not cached and Settings.RequeryActivityBatches is False:
         sys.stdout.flush()
         sys.stderr.write('Error: Cannot read activity batches from cache: File not found: ' + filename + "\n")
         exit(1)
 
-    requery = Settings.RequeryActivityBatches
+    [after, before] = Settings.Filters.getDateWindow()
+
+    sync = None
+    if data_store is not None:
+        sync = data_store.load_sync(file_identifier) if cached else None
+    elif stored_filename is not None and os.path.exists(sync_filename):
+        with open(sync_filename, "r") as f:
+            sync = json.load(f)
+
+    artifact = f"activities_{file_identifier}"
+
+    # a fresh history still misses activities if it was requested for other "date" filters
+    if Settings.RequeryActivityBatches is None and cached and not sync_covers_date_window(sync, after, before):
+        print("Cached " + artifact + " does not cover the date filters, requesting it again")
+        requery = True
+    else:
+        requery = needs_requery(Settings.RequeryActivityBatches, artifact, Settings.ActivityBatchesMaxAgeHours,
+                                cached)
 
     if requery:
+        fetched = time.time()
         membership_id = player_id
         membership_type = player_membership
 
@@ -186,190 +1041,157 @@ def get_activity_batches(player_id, player_membership, file_identifier: str) ->
             )
         )
 
-        _activities = []
-
-        for character_id in account["characters"]["data"]:
-            character_type = account["characters"]["data"][character_id]["classType"]
-            character_name = aiobungie.Class(character_type).__str__()
+        characters = account["characters"]["data"]
 
-            print("Requesting activities for character with ID " + str(character_id) + " (" + character_name + ")")
+        previous = []
+        stored = data_store is None and sync is not None
 
-            for i in range(500):
-                data = get(
-                    "/Destiny2/{membershipType}/Account/{destinyMembershipId}/Character/{characterId}/Stats/Activities/?mode=0&count=250&page={page}"
-                        .format(
-                        membershipType=membership_type,
-                        destinyMembershipId=membership_id,
-                        characterId=character_id,
-                        page=i
-                    )
-                )
-
-                if "activities" not in data:
-                    print("Loaded data for " + character_name + ", " + str(len(_activities)) + " batches total")
-                    break
+        if data_store is not None:
+            previous = data_store.load_newest_batches(file_identifier)
+        elif stored:
+            # the batches of a character are stored newest-first
+            newest_batches = {}
+            for batch in read_json_array(stored_filename):
+                newest_batches.setdefault(batch.get("characterId"), batch)
 
-                _activities.append({
-                    "character": character_type,
-                    "data": data["activities"],
-                    "from": iso_to_nice_iso(data["activities"][-1]["period"]),
-                    "to": iso_to_nice_iso(data["activities"][0]["period"])
-                })
+            previous = list(newest_batches.values())
+            print('Read activity batches to update from ' + stored_filename)
 
-                print("Requested " + character_name + " activity page " + str(i)
-                      + ", ranging from " + data["activities"][-1]["period"]
-                      + " to " + data["activities"][0]["period"])
+        _activities, sync, kept = asyncio.run(queue_character_activities(membership_type, membership_id,
+                                                                         characters, after, before, previous, sync))
 
         print("Loaded data for all characters.")
 
-        with open(filename, "w") as f:
-            json.dump(_activities, f)
+        if data_store is not None:
+            data_store.save_batches(file_identifier, _activities, sync, get_activity_modes)
             print('Saved activity batches to ' + filename)
+        else:
+            def stored_batches():
+                if not stored:
+                    return
 
-    with open(filename, "r") as f:
-        print('Read activity batches from ' + filename)
-        return json.load(f)[::-1]
-
-
-def filter_activities(batches: list) -> list:
-    """
-    Filters and flattens activity batches.
-
-    :param batches: The list of batches.
-    :return:
-    """
-    final_results = []
-    indices_to_remove = []
-
-    filters = Settings.Filters.getFilters()
-    batch_amount = len(batches)
+                for batch in read_json_array(stored_filename):
+                    if batch.get("characterId") in kept:
+                        # batches stored before timestamps were added to activities get them now
+                        for activity in batch["data"]:
+                            get_activity_timestamp(activity)
 
-    print("Applying filters to batches...")
+                        yield batch
 
-    for batch_index in range(batch_amount):
-        batch = batches[batch_index]
+            # the new batches go in front of the stored ones, which are streamed over one at a time
+            write_json_array(filename, itertools.chain(_activities, stored_batches()))
+            print('Saved activity batches to ' + filename)
 
-        for filter_data in filters:
-            filter_type = filter_data["type"]
-            filter_op = filter_data["operator"]
-            filter_value = filter_data["value"]
+            with open(sync_filename, "w") as f:
+                json.dump(sync, f)
 
-            if filter_type == "character":
-                if filter_op == "is":
-                    if batch["character"] != filter_value:
-                        indices_to_remove.append(batch_index)
-                        break
+            # any other variant is outdated now, even one that was not read because its sync state was missing
+            for variant in get_cache_file_variants(plain_filename):
+                if variant != filename and os.path.exists(variant):
+                    os.remove(variant)
+                    print('Removed ' + variant + ', which was replaced by ' + filename)
 
-                if filter_op == "is not":
-                    if batch["character"] == filter_value:
-                        indices_to_remove.append(batch_index)
-                        break
+            stored_filename = filename
 
-                if filter_op == "in":
-                    if batch["character"] not in filter_value:
-                        indices_to_remove.append(batch_index)
-                        break
+        get_fetch_times().set_fetch_time(artifact, fetched)
 
-                if filter_op == "not in":
-                    if batch["character"] in filter_value:
-                        indices_to_remove.append(batch_index)
-                        break
+    if data_store is not None:
+        return None
 
-            if filter_type == "date":
+    print('Read activity batches from ' + stored_filename)
+    return read_json_array(stored_filename)
 
-                if filter_op == "before":
-                    # if batch beginning is after set time
-                    batch_from = datetime.fromisoformat(batch["from"])
-                    value_before = datetime.fromisoformat(filter_value)
 
-                    if batch_from > value_before:
-                        indices_to_remove.append(batch_index)
-                        break
+def filter_activities(batches) -> list:
+    """
+    Filters and flattens activity batches.
 
-                if filter_op == "after":
-                    # if batch end is before set time
-                    batch_to = datetime.fromisoformat(batch["to"])
-                    value_after = datetime.fromisoformat(filter_value)
+    The batches are gone through one at a time, and only a summary of the activities that pass is kept,
+    see summarize_activity().
 
-                    if batch_to < value_after:
-                        indices_to_remove.append(batch_index)
-                        break
+    :param batches: The batches (or an iterator of them), as returned by get_activity_batches().
+    :return: The activities that passed all filters, as one run per character, oldest-first.
+             See sort_activities_by_date() to merge them.
+    """
+    runs = []
 
-    # remove marked batches
-    batches = [element for i, element in enumerate(batches) if i not in indices_to_remove]
+    keep_batch = Settings.Filters.compileBatchFilter()
+    keep_activity = Settings.Filters.compileActivityFilter(get_activity_modes)
 
-    print("Applying filters to single activities...")
+    print("Applying filters to activities...")
 
     for batch in batches:
-        indices_to_remove = []
-        data = batch["data"]
+        if keep_batch(batch):
+            # the activities in a batch are newest-first
+            runs.append([summarize_activity(activity) for activity in reversed(batch["data"])
+                         if keep_activity(activity)])
 
-        for i in range(len(data)):
-            activity = data[i]
+    print("Done applying filters.")
 
-            for filter_data in filters:
-                filter_type = filter_data["type"]
-                filter_op = filter_data["operator"]
-                filter_value = filter_data["value"]
+    # the batches of a character are newest-first as well
+    return [activity for run in reversed(runs) for activity in run]
 
-                if filter_type == "date":
-                    activity_date = datetime.fromisoformat(iso_to_nice_iso(activity["period"]))
 
-                    if filter_op == "before":
-                        # if batch beginning is after set time
-                        value_before = datetime.fromisoformat(filter_value)
+def summarize_activity(activity: dict) -> dict:
+    """
+    Drops everything from an activity that is not needed after filtering, like its stats,
+    so a long activity history takes up a lot less memory.
 
-                        if activity_date > value_before:
-                            indices_to_remove.append(i)
-                            break
+    :param activity: An activity from the activity history.
+    :return: The activity, with the same keys SqliteStore.query_activities() returns.
+    """
+    details = activity["activityDetails"]
+    values = activity.get("values", {})
+
+    return {
+        "period": activity["period"],
+        "timestamp": get_activity_timestamp(activity),
+        "activityDetails": {"instanceId": details["instanceId"], "referenceId": details.get("referenceId"),
+                            "mode": details.get("mode"), "modes": details.get("modes", [])},
+        "values": {"playerCount": values["playerCount"]} if "playerCount" in values else {}
+    }
 
-                    if filter_op == "after":
-                        # if batch end is before set time
-                        value_after = datetime.fromisoformat(filter_value)
 
-                        if activity_date < value_after:
-                            indices_to_remove.append(i)
-                            continue
+def get_player_count(activity: dict):
+    """
+    :param activity: An activity from the activity history.
+    :return: The amount of players in the activity, None if Bungie did not tell.
+    """
+    try:
+        return int(activity["values"]["playerCount"]["basic"]["value"])
+    except (KeyError, TypeError, ValueError):
+        return None
 
-                if filter_type == "activity":
-                    continue
 
-                    # FIXME: this just filters out every single activity
+def skip_solo_activities(activities: list) -> list:
+    """
+    Removes activities that had no other players in them, so no PGCRs are requested for them.
 
-                    # if filter_op == "is":
-                    #     if filter_value not in activity["activityDetails"]["modes"]:
-                    #         indices_to_remove.append(i)
-                    #         break
+    :param activities: A list of activities.
+    :return: The activities with other players in them, or an unknown amount of players, in the same order.
+    """
+    kept = []
 
-                    # if filter_op == "in":
-                    #     flag = 0
-                    #     for filter_value_element in filter_value:
-                    #         if filter_value_element in activity["activityDetails"]["modes"]:
-                    #             flag = 1
-                    #             break
-                    #     if flag == 0:
-                    #         indices_to_remove.append(i)
-                    #         break
+    for activity in activities:
+        player_count = get_player_count(activity)
 
-                    # if filter_op == "is not":
-                    #     if filter_value in activity["activityDetails"]["modes"]:
-                    #         indices_to_remove.append(i)
-                    #         break
+        if player_count is None or player_count > 1:
+            kept.append(activity)
 
-                    # if filter_op == "not in":
-                    #     for filter_value_element in filter_value:
-                    #         if filter_value_element in activity["activityDetails"]["modes"]:
-                    #             indices_to_remove.append(i)
-                    #             break
+    if len(kept) < len(activities):
+        print("Skipping " + str(len(activities) - len(kept)) + " activities without other players")
 
-        # remove marked elements
-        batch = [element for i, element in enumerate(data) if i not in indices_to_remove]
+    return kept
 
-        final_results.extend(batch)
 
-    print("Done applying filters.")
+def is_prioritized_activity(activity: dict) -> bool:
+    """
+    :param activity: An activity from the activity history.
+    :return: Whether the activity has one of Settings.PrioritizedActivityModes.
+    """
+    modes = get_activity_modes(activity)
 
-    return final_results
+    return any(int(mode) in modes for mode in Settings.PrioritizedActivityModes)
 
 
 def print_batch_details(batches: list) -> None:
@@ -380,7 +1202,7 @@ def print_batch_details(batches: list) -> None:
     """
     for batch in batches:
         print(
-            aiobungie.Class(batch["character"]).__str__() + " batch,"
+            get_class_name(batch["character"]) + " batch,"
             + " ranging from " + batch["from"]
             + " to " + batch["to"]
         )
@@ -390,192 +1212,567 @@ def sort_activities_by_date(activities: list) -> list:
     """
     Sorts a list of activities by date using the "period" key.
 
+    Python's sort finds runs that are sorted already and merges them, so merging the runs of a few characters
+    or players costs about as much as going through the list once.
+
     :param activities: The activities to sort.
     :return: The activities, sorted.
     """
-    activities.sort(key=lambda x: datetime.fromisoformat(iso_to_nice_iso(x["period"])))
+    activities.sort(key=get_activity_timestamp)
     return activities
 
 
-async def request_activity_players(activity_id) -> list:
+def create_curl_pool() -> CurlPool:
     """
-    Does a single curl request for an activity. Throttles and delays if met with an error.
+    Creates a curl pool for requests to the Bungie API. Needs to be called inside a running event loop.
 
-    :param activity_id: The activity ID to look up.
-    :return: Array with two elements [data, blocking]. data is the response data, blocking is the amount of seconds
-             Bungie wants us to throttle (usually 2)
+    :return: The curl pool.
     """
-
-    handle = None
-    try:
-        handle = aiocurl.Curl()
-    except aiocurl.error as e:
-        sys.stdout.flush()
-        sys.stderr.flush()
-        sys.stderr.write("[ERROR] aiocurl.error: " + str(e) + "\n")
-        sys.stderr.write("[ERROR] curl init failed - we likely ran out of connections to use" + "\n")
-        sys.stderr.write("[ERROR] Exiting." + "\n")
-        sys.stderr.flush()
-        exit(1)
-
-    handle.setopt(
-        aiocurl.URL,
-        "https://stats.bungie.net/Platform/Destiny2/Stats/PostGameCarnageReport/{}/".format(activity_id)
-    )
-
-    handle.setopt(
-        aiocurl.HTTPHEADER,
-        [
+    return CurlPool(
+        size=Settings.Advanced_AsyncThreadAmount,
+        connections=Settings.Advanced_ConnectionPoolSize,
+        connect_timeout=Settings.Advanced_ConnectTimeout,
+        timeout=Settings.Advanced_RequestTimeout,
+        header_list=[
             "X-Api-Key: " + headers["X-Api-Key"],
-            "Connection: close",
             "Accept: application/json"
         ]
     )
 
-    handle.setopt(aiocurl.HTTP_VERSION, aiocurl.CURL_HTTP_VERSION_2_PRIOR_KNOWLEDGE)
-    handle.setopt(aiocurl.SSL_VERIFYPEER, False)
-    handle.setopt(aiocurl.FOLLOWLOCATION, True)
-    if Settings.Advanced_CurlVerbose:
-        handle.setopt(aiocurl.VERBOSE, True)
 
-    data = BytesIO()
-    handle.setopt(aiocurl.WRITEFUNCTION, data.write)
+async def perform_request(pool: CurlPool, url: str) -> tuple:
+    """
+    Does a single curl GET request, without any retries.
+
+    :param pool: The curl pool to do the request with.
+    :param url: The full URL to request.
+    :return: A tuple (status code, response body, decoded Bungie response or None if the body was not JSON).
+    :raises aiocurl.error: If curl fails to perform the request, e.g. because it timed out.
+    """
+    token = metrics.request_started(url)
+
+    try:
+        code, body = await pool.perform(url)
+    except aiocurl.error:
+        metrics.request_failed(token)
+        raise
+    except asyncio.CancelledError:
+        metrics.request_cancelled(token)
+        raise
+
+    try:
+        data = json.loads(body.decode("utf8"))
+    except ValueError:
+        data = None
+
+    metrics.request_finished(token, code, data, len(body))
+
+    return code, body, data
+
+
+async def perform_hedged_request(pool: CurlPool, url: str) -> tuple:
+    """
+    Does a single curl GET request. If it takes longer than Settings.Advanced_HedgeQuantile of the earlier requests
+    to the same endpoint, a second one is started, and whichever answers first is taken.
+
+    :param pool: The curl pool to do the requests with.
+    :param url: The full URL to request.
+    :return: See perform_request().
+    :raises aiocurl.error: If all requests failed.
+    """
+    delay = None
+
+    if Settings.Advanced_HedgeQuantile is not None:
+        delay = metrics.latency_quantile(url, Settings.Advanced_HedgeQuantile)
+
+    if delay is None:
+        return await perform_request(pool, url)
+
+    async def perform_hedge():
+        await rate_limiter.acquire()
+        return await perform_request(pool, url)
+
+    pending = {asyncio.ensure_future(perform_request(pool, url))}
+
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+
+        if len(done) == 0:
+            metrics.retried("hedge")
+            pending.add(asyncio.ensure_future(perform_hedge()))
+
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+
+            if len(pending) == 0:
+                # all failed
+                return done.pop().result()
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def request_bungie(pool: CurlPool, url: str):
+    """
+    Does a curl GET request to the Bungie API, retrying failed requests up to Settings.Advanced_MaxRetries times,
+    and throttled ones up to Settings.Advanced_MaxThrottleRetries times.
+    Every attempt goes through the shared rate limiter, which backs off if met with throttling or an error.
+
+    :param pool: The curl pool to do the request with.
+    :param url: The full URL to request.
+    :return: The Bungie Response content.
+    """
+    attempt = 0
+    throttled = 0
+
+    while True:
+        await rate_limiter.acquire()
 
-    flag = 0
-    while flag == 0:
         try:
-            await handle.perform()
-            flag = 1
-        except aiocurl.error:
-            print("[WARN] curl threw error - waiting 30 seconds before proceeding")
-            time.sleep(30)
+            code, body, data = await perform_hedged_request(pool, url)
+        except aiocurl.error as e:
+            # the connection might be overloaded, unlike with a server error
+            rate_limiter.decrease()
+            error = "curl error " + str(e)
+        else:
+            if rate_limiter.report(code, data):
+                throttled += 1
+
+                if throttled > Settings.Advanced_MaxThrottleRetries:
+                    raise ConnectionError("Request to " + url + " was throttled " + str(throttled) + " times")
+
+                metrics.retried("throttle")
+                continue
+
+            if code < 500:
+                break
+
+            error = "status code " + str(code)
 
-    code = handle.getinfo(aiocurl.HTTP_CODE)
+        attempt += 1
 
-    handle.close()
+        if attempt > Settings.Advanced_MaxRetries:
+            raise ConnectionError("Request to " + url + " failed " + str(attempt) + " times: " + error)
+
+        delay = get_retry_delay(attempt)
+        print("[WARN] Request failed (" + error + f") - retrying in {delay:.1f} seconds")
+        metrics.retried("error")
+        await asyncio.sleep(delay)
 
     if str(code) == "200":
-        data = json.loads(data.getvalue().decode("utf8"))
-        blocking = data["ThrottleSeconds"]
-        response = data["Response"]
-        return [response, blocking]
+        return data["Response"]
 
-    raise ConnectionError("Bungie API raised error: " + data.getvalue().decode("utf8"))
+    raise ConnectionError("Bungie API raised error: " + body.decode("utf8"))
 
 
-async def queue_activity_players(activities: list):
+async def request_activity_players(pool: CurlPool, activity_id) -> dict:
     """
-    Queue an asyncio request for all the given activities.
+    Does a single curl request for the PGCR of an activity.
 
-    :param activities: A list of the activities to queue.
-    :return: The combined results of the queries, in a list.
+    :param pool: The curl pool to do the request with.
+    :param activity_id: The activity ID to look up.
+    :return: The response data.
     """
-    tasks = []
-    for activity in activities:
-        task = asyncio.create_task(request_activity_players(activity["activityDetails"]["instanceId"]))
-        tasks.append(task)
-
-    return await asyncio.gather(*tasks)
+    return await request_bungie(
+        pool,
+        Settings.Advanced_StatsRoot + "/Destiny2/Stats/PostGameCarnageReport/{}/".format(activity_id)
+    )
 
 
-def chunk_and_get_activity_players(activities: list) -> list:
+async def queue_activity_players(activities: list, on_result=None) -> list:
     """
-    Chunks a list of activities and requests the details in chunks.
+    Requests the details of all given activities on a single event loop.
 
-    :param activities: The list of activities.
-    :return: A list of all the activity details.
+    The activities are fed through a work queue to a fixed amount of workers, so there are always
+    Settings.Advanced_AsyncThreadAmount requests in flight and a new one starts as soon as one finishes.
+
+    :param activities: A list of the activities to queue.
+    :param on_result: Optional callback (index, details) -> bool, called for every finished request.
+                      If it returns True, no new requests are started.
+    :return: The combined results of the queries, in the order of the given activities.
+             If on_result is given, the results are handed to it instead and not collected here.
     """
     length = len(activities)
+    results = [None] * length
 
-    activity_details = []
+    queue = asyncio.Queue()
+    for index, activity in enumerate(activities):
+        queue.put_nowait((index, activity))
 
-    chunksize = Settings.Advanced_AsyncThreadAmount
+    state = {
+        "finished": 0,
+        "stopped": False
+    }
 
-    print("Requesting detailed PGCRs from Bungie, this can take a while...")
+    async def worker():
+        while not state["stopped"]:
+            try:
+                index, activity = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
 
-    for i in range(0, length, chunksize):
-        data = asyncio.run(queue_activity_players(activities[i:i + chunksize]))
+            details = await request_activity_players(pool, activity["activityDetails"]["instanceId"])
 
-        for activity in data:
-            [details, blocking] = activity
+            if on_result is None:
+                results[index] = details
+            elif on_result(index, details) and not state["stopped"]:
+                print("Found everything we were looking for, not requesting any more PGCRs.")
+                state["stopped"] = True
 
-            activity_details.append(details)
-            if blocking > 0:
-                print("Sleeping {} seconds because Bungie told us to".format(blocking))
-                time.sleep(blocking)
-                print("Continuing.")
+            state["finished"] += 1
+            finished = state["finished"]
 
-        print(
-            "Requested players for " + str(i + chunksize) + " / " + str(length) + " activities ("
-            + f"{((i + chunksize) * 100.0) / length:.2f}" + "%)"
-        )
+            if finished % Settings.Advanced_AsyncThreadAmount == 0 or finished == length:
+                print(
+                    "Requested players for " + str(finished) + " / " + str(length) + " activities ("
+                    + f"{(finished * 100.0) / length:.2f}" + "%)"
+                )
+
+    pool = create_curl_pool()
+
+    try:
+        workers = [asyncio.create_task(worker()) for _ in range(min(Settings.Advanced_AsyncThreadAmount, length))]
+        await asyncio.gather(*workers)
+    finally:
+        pool.close()
+
+    return results
+
+
+def get_activity_players(activities: list, on_result=None) -> list:
+    """
+    Requests the details of a list of activities.
+
+    :param activities: The list of activities.
+    :param on_result: Optional callback to receive the details and stop early, see queue_activity_players().
+    :return: A list of all the activity details, if on_result is not given.
+    """
+    print("Requesting detailed PGCRs from Bungie, this can take a while...")
+
+    activity_details = asyncio.run(queue_activity_players(activities, on_result))
 
     print("Finished loading PGCRs.")
 
     return activity_details
 
 
-def get_activity_details(activities: list,
-                         file_identifier: str = 'unknown') -> list:
+def open_pgcr_cache(file_identifier: str):
     """
-    Gets the details of the given activities and saves them to file.
+    Opens the cache for activity details: the SQLite store if enabled, then the shared store if enabled,
+    the players_*.json file (or its compressed variant, see Settings.CompressCaches) otherwise.
 
     :param file_identifier: The name to add to the filename
-    :param activities: The list of activities to query.
-    :return: The full list of the activity details, with all player IDs.
+    :return: The cache, see JsonPgcrCache for its interface.
     """
+    data_store = get_store()
+
+    if data_store is not None:
+        return data_store
+
+    if Settings.SharedActivityDetails:
+        max_megabytes = Settings.SharedActivityDetailsMaxMegabytes
+
+        return SharedPgcrStore(os.path.join(Settings.DataFolder, "pgcrs"), Settings.SlimActivityDetails,
+                               int(max_megabytes * 2 ** 20) if max_megabytes is not None else None)
 
     filename = os.path.join(Settings.DataFolder, f"players_{file_identifier}.json")
 
-    if not os.path.exists(filename) and not Settings.RequeryActivityDetails:
+    cached = os.path.exists(filename) or os.path.exists(JsonPgcrCache.compressed_filename_of(filename))
+
+    if not cached and Settings.RequeryActivityDetails is False:
         sys.stdout.flush()
         sys.stderr.write('Error: Cannot read activity details from cache: File not found: ' + filename + "\n")
         exit(1)
 
-    requery = Settings.RequeryActivityDetails
+    return JsonPgcrCache(filename, Settings.SlimActivityDetails, Settings.Advanced_MemoryMapCaches,
+                         Settings.CompressCaches)
 
-    if requery:
-        players = chunk_and_get_activity_players(activities)
 
-        # Writing to sample.json
-        with open(filename, "w") as f:
-            json.dump(players, f)
-        print('Saved activity details to ' + filename)
+def get_activity_details(activities: list,
+                         file_identifier: str = 'unknown',
+                         first_meetings: FirstMeetings = None,
+                         cache=None):
+    """
+    Gets the details of the given activities and saves them to file.
+
+    PGCRs never change once written, so the file acts as a cache keyed by instanceId:
+    only activities missing from it are requested from Bungie.
 
-    with open(filename, "r") as f:
-        print('Read activity details from ' + filename)
-        return json.load(f)
+    :param file_identifier: The name to add to the filename
+    :param activities: The list of activities to query, sorted oldest-first if first_meetings is given.
+    :param first_meetings: If given, the details are fed into it in order,
+                           and requesting stops as soon as it has found everything.
+    :param cache: The cache to use, see open_pgcr_cache(). Opened from file_identifier if not given.
+    :return: An iterator of the activity details, with all player IDs, in the order of the given activities.
+    """
+
+    if cache is None:
+        cache = open_pgcr_cache(file_identifier)
+
+    instance_ids = [str(activity["activityDetails"]["instanceId"]) for activity in activities]
+    available = [cache.has_pgcr(instance_id) for instance_id in instance_ids]
+
+    # amount of leading details that have been fed into first_meetings
+    state = {
+        "position": 0
+    }
+
+    def feed_first_meetings() -> bool:
+        if first_meetings is None:
+            return False
+
+        position = state["position"]
+
+        while not first_meetings.is_done() and position < len(available) and available[position]:
+            details = cache.get_pgcr(instance_ids[position])
+
+            # removed by another run sharing the cache since, so it is requested again
+            if details is None:
+                available[position] = False
+                break
+
+            first_meetings.add(details)
+            position += 1
+
+        state["position"] = position
+        return first_meetings.is_done()
+
+    # details never change, so only the missing ones are requested, unless that is turned off
+    requery = Settings.RequeryActivityDetails is not False
+
+    if requery and not feed_first_meetings():
+        missing = [index for index in range(len(activities)) if not available[index]]
+
+        # fireteam activities are the most likely to have clanmates in them,
+        # unless first meetings are searched, which need to be requested oldest-first
+        if first_meetings is None:
+            missing.sort(key=lambda index: not is_prioritized_activity(activities[index]))
+
+        print(str(len(activities) - len(missing)) + " / " + str(len(activities))
+              + " activity details found in cache, requesting the remaining " + str(len(missing)))
+
+        def on_result(missing_index, details) -> bool:
+            cache.put_pgcr(details)
+            available[missing[missing_index]] = True
+            return feed_first_meetings()
+
+        if len(missing) > 0:
+            get_activity_players([activities[index] for index in missing], on_result)
+
+    cache.save()
+    feed_first_meetings()
+
+    return read_cached_details(cache, (instance_ids[index] for index in range(len(activities)) if available[index]))
+
+
+def read_cached_details(cache, instance_ids):
+    """
+    Reads activity details from a cache one at a time.
+
+    :param cache: The cache, see open_pgcr_cache().
+    :param instance_ids: The instanceIds of the activities.
+    :return: An iterator of the activity details, skipping those that are not cached (any more).
+    """
+    for instance_id in instance_ids:
+        details = cache.get_pgcr(instance_id)
+
+        # another run sharing the cache might have removed the details after they were found
+        if details is not None:
+            yield details
+
+
+def get_sorted_activities(activity_batches, file_identifier: str) -> list:
+    """
+    Filters and sorts the activities of a player.
+
+    :param activity_batches: The batches returned by get_activity_batches().
+    :param file_identifier: The name the activities are stored under.
+    :return: The filtered activities, oldest-first.
+    """
+
+    # filters reduce the calls to the Bungie API,
+    # and also narrow down cached activity details
+    if Settings.UseSqliteStore:
+        activities = get_store().query_activities(file_identifier, Settings.Filters)
+    else:
+        activities = sort_activities_by_date(activities=filter_activities(batches=activity_batches))
+
+    if Settings.SkipSoloActivities:
+        activities = skip_solo_activities(activities)
+
+    return activities
+
+
+def index_clanmates(clanmates: list) -> dict:
+    """
+    Builds a lookup table of all memberships of all clanmates.
+
+    :param clanmates: The list of all clanmates, with all platforms.
+    :return: A dict mapping each membershipId (as string) to a tuple (clanmate, displayName).
+    """
+    index = {}
 
+    for clanmate in clanmates:
+        for clanmate_platform in clanmate["profiles"]:
+            index.setdefault(
+                str(clanmate_platform["membershipId"]),
+                (clanmate, clanmate_platform["displayName"])
+            )
+
+    return index
 
-def compare_against_clanmates(activities: list, clanmates: list) -> None:
+
+def compare_against_clanmates(activities, clanmates: list) -> None:
     """
     Compare activity details against clanmate list.
 
-    :param activities: The activity list, with player details.
+    :param activities: The activity list (or iterator), with player details, as Bungie responses or SlimPgcrs.
     :param clanmates: The list of all clanmates, with all platforms.
     """
 
     print("Showing games with teammates...")
 
+    clanmate_index = index_clanmates(clanmates)
     counter = 0
 
     for activity in activities:
-        for activity_player in activity["entries"]:
-            for clanmate in clanmates:
-                for clanmate_platform in clanmate["profiles"]:
-                    activity_player_id = activity_player["player"]["destinyUserInfo"]["membershipId"]
-                    clanmate_player_id = clanmate_platform["membershipId"]
+        activity = SlimPgcr.of(activity)
+
+        for activity_player_id in activity.membership_ids:
+            match = clanmate_index.get(activity_player_id)
+
+            if match is None:
+                continue
+
+            [_, player_name] = match
+            activity_date = activity.period
+
+            print("[" + activity_date + "] " + describe_activity(activity.instance_id, activity.reference_id)
+                  + " has clanmate " + player_name)
+
+            counter += 1
+            if Settings.OnlyListFirstN != 0 and counter >= Settings.OnlyListFirstN:
+                return
+
+
+def compare_against_clanmates_in_store(player: str, clan_key: str) -> None:
+    """
+    Compare activity details against clanmates, using the SQLite store.
+
+    :param player: The name the activities are stored under.
+    :param clan_key: Identifies the clan and the skipped player, see get_clan_key().
+    """
+
+    print("Showing games with teammates...")
+
+    for [activity_date, activity_id, activity_hash, player_name] in get_store().query_clanmate_matches(
+            player, clan_key, Settings.Filters, Settings.OnlyListFirstN):
+        print("[" + activity_date + "] " + describe_activity(activity_id, activity_hash)
+              + " has clanmate " + player_name)
+
+
+def get_batch_players(clan_id) -> list:
+    """
+    Gets the players of a batch run, see Settings.BatchPlayers.
+
+    :param clan_id: GroupId of the clan, used if the whole clan should be run.
+    :return: A list of tuples (membershipId, membershipType, display name).
+    """
+    if Settings.BatchPlayers != "clan":
+        return [get_player(player_bungiename) for player_bungiename in Settings.BatchPlayers]
+
+    players = []
+
+    for member in asyncio.run(queue_clan_roster(clan_id)):
+        user_info = member["destinyUserInfo"]
+        players.append((
+            str(user_info["membershipId"]),
+            user_info["membershipType"],
+            user_info.get("bungieGlobalDisplayName") or user_info["displayName"]
+        ))
+
+    return players
+
+
+def run_batch():
+    """
+    Finds the clanmates of several players at once, see Settings.BatchPlayers.
 
-                    if activity_player_id == clanmate_player_id:
-                        player_name = clanmate_platform["displayName"]
-                        activity_date = activity["period"]
-                        activity_id = activity["activityDetails"]["instanceId"]
+    Clanmates play together, so the activities of all players are combined and every PGCR is only requested once.
+    """
+    players = get_batch_players(Settings.ClanId)
+
+    print("Running for " + str(len(players)) + " players")
+
+    clan_members = get_clan_members_with_all_memberships(clan_id=Settings.ClanId,
+                                                         skip=None)
+
+    player_activities = []
+    found_players = []
+
+    for player_id, player_membership, player_name in players:
+        # display names are not unique without their #code, which clan rosters do not always have
+        file_identifier = "player_" + str(player_id)
+
+        # one player with a private or broken history should not stop the whole batch
+        try:
+            activity_batches = get_activity_batches(player_id=player_id,
+                                                    player_membership=player_membership,
+                                                    file_identifier=file_identifier)
+
+            player_activities.append(get_sorted_activities(activity_batches, file_identifier))
+        except (ConnectionError, KeyError) as e:
+            print("[WARN] Skipping " + player_name + ", whose activity history could not be requested: "
+                  + repr(e))
+            continue
+
+        found_players.append((player_id, player_membership, player_name))
+
+    # every activity is only requested once, no matter how many players took part
+    unique_activities = {}
+    for activities in player_activities:
+        for activity in activities:
+            unique_activities.setdefault(str(activity["activityDetails"]["instanceId"]), activity)
+
+    print(str(sum(len(activities) for activities in player_activities)) + " activities of all players contain "
+          + str(len(unique_activities)) + " different activities")
+
+    cache = open_pgcr_cache("clan_" + str(Settings.ClanId))
+
+    # this is the costly request
+    get_activity_details(activities=sort_activities_by_date(list(unique_activities.values())),
+                         cache=cache)
+
+    for [player_id, _, player_name], activities in zip(found_players, player_activities):
+        print("")
+        print("Results for " + player_name + ":")
 
-                        print("[" + activity_date + "] Activity " + str(activity_id) + " has clanmate " + player_name)
+        clanmates = [clanmate for clanmate in clan_members
+                     if all(str(profile["membershipId"]) != player_id for profile in clanmate["profiles"])]
 
-                        counter += 1
-                        if Settings.OnlyListFirstN != 0 and counter >= Settings.OnlyListFirstN:
-                            return
+        activities_with_players = read_cached_details(cache, (activity["activityDetails"]["instanceId"]
+                                                              for activity in activities))
+
+        # output results
+        if Settings.OnlyFirstMeetings:
+            first_meetings = FirstMeetings(clanmate_index=index_clanmates(clanmates),
+                                           clanmate_amount=len(clanmates),
+                                           limit=Settings.OnlyListFirstN)
+
+            for details in activities_with_players:
+                if first_meetings.add(details):
+                    break
+
+            first_meetings.print(describe_activity)
+        else:
+            compare_against_clanmates(activities=activities_with_players,
+                                      clanmates=clanmates)
 
 
 def run():
@@ -588,10 +1785,30 @@ def run():
 
     # set specific values
     headers.update({"X-Api-Key": Settings.ApiKey})
+    rate_limiter.set_max_rate(Settings.Advanced_MaxRequestsPerSecond)
 
     # make sure
     os.makedirs(Settings.DataFolder, exist_ok=True)
 
+    metrics.start_reporting(Settings.Advanced_MetricsInterval, Settings.Advanced_MetricsFile)
+
+    try:
+        # activities are classified with it before any activity details are requested
+        get_manifest()
+
+        if Settings.BatchPlayers is not None:
+            run_batch()
+        else:
+            run_player()
+    finally:
+        metrics.stop_reporting(Settings.Advanced_MetricsFile)
+        close_store()
+
+
+def run_player():
+    """
+    Finds the clanmates of Settings.BungieName.
+    """
     player_id, player_membership, player_name = get_player()
 
     clan_members = get_clan_members_with_all_memberships(clan_id=Settings.ClanId,
@@ -602,16 +1819,35 @@ def run():
                                             player_membership=player_membership,
                                             file_identifier=player_name)
 
-    # note that this filter will only reduce the calls to the Bungie API,
-    # and will *not* work if you don't requery get_activity_details()!
-    activities = filter_activities(batches=activity_batches)
+    activities = get_sorted_activities(activity_batches, player_name)
 
-    activities = sort_activities_by_date(activities=activities)
+    if Settings.OnlyFirstMeetings:
+        first_meetings = FirstMeetings(clanmate_index=index_clanmates(clan_members),
+                                       clanmate_amount=len(clan_members),
+                                       limit=Settings.OnlyListFirstN)
 
-    # this is the costly request
-    activities_with_players = get_activity_details(activities=activities,
-                                                   file_identifier=player_name)
+        # this is the costly request, but stops as soon as everyone has been found
+        get_activity_details(activities=activities,
+                             file_identifier=player_name,
+                             first_meetings=first_meetings)
+
+        # output results
+        first_meetings.print(describe_activity)
+
+    elif Settings.UseSqliteStore:
+        # this is the costly request
+        get_activity_details(activities=activities,
+                             file_identifier=player_name)
+
+        # output results
+        compare_against_clanmates_in_store(player=player_name,
+                                           clan_key=get_clan_key(Settings.ClanId, player_id))
+
+    else:
+        # this is the costly request
+        activities_with_players = get_activity_details(activities=activities,
+                                                       file_identifier=player_name)
 
-    # output results
-    compare_against_clanmates(activities=activities_with_players,
-                              clanmates=clan_members)
+        # output results
+        compare_against_clanmates(activities=activities_with_players,
+                                  clanmates=clan_members)